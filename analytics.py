@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Statistics of all the pieces in output/, made with a pool of processes.
+
+    ./analytics.py --workers 4 --out analytics.json
+
+Each worker loads a chunk of pieces and counts them, and the chunks'
+counts are added together. The result is JSON:
+
+    n_pieces        the number of pieces counted
+    histograms      corpus-wide counts:
+        solos           states where only that musician plays
+        density         states with that many musicians playing
+        chord_types     chord types of the harmonies, like "0,4,7"
+        pitch_classes   harmonies with that pitch class in them
+    distributions   the number of pieces with each value of:
+        n_events, gaps, tutti
+    failed          pieces that couldn't be loaded, with the error
+
+"""
+
+import json
+import time
+import traceback
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+from argparse import ArgumentParser
+
+import backup
+from index import get_stats, counted, columns
+
+
+def summarize(paths):
+    """Count the pieces in `paths` together."""
+    summary = {
+        'n_pieces': 0,
+        'histograms': {name: Counter() for name in counted},
+        'distributions': {name: Counter() for name in columns},
+        'failed': {},
+    }
+    for path in paths:
+        try:
+            stats = get_stats(path)
+        except Exception:
+            summary['failed'][path] = traceback.format_exc().splitlines()[-1]
+            continue
+
+        summary['n_pieces'] += 1
+        for name in counted:
+            summary['histograms'][name].update(stats[name])
+        for name in columns:
+            summary['distributions'][name][stats[name]] += 1
+
+    return summary
+
+
+def merge(total, summary):
+    total['n_pieces'] += summary['n_pieces']
+    for kind in ['histograms', 'distributions']:
+        for name, counter in summary[kind].items():
+            total[kind][name].update(counter)
+    total['failed'].update(summary['failed'])
+
+
+def analyze(output_path='output', workers=None, chunk_size=50):
+    paths = [path for path in backup.get_piece_paths(output_path) if backup.get_backup_path(path)]
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+
+    total = summarize([])
+    if workers == 1:
+        for chunk in chunks:
+            merge(total, summarize(chunk))
+    else:
+        pool = Pool(workers or cpu_count())
+        try:
+            for summary in pool.imap_unordered(summarize, chunks):
+                merge(total, summary)
+        finally:
+            pool.terminate()
+
+    return total
+
+
+def cli():
+    parser = ArgumentParser(description='Count things across all the pieces in output/')
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with the house_* pieces.')
+    parser.add_argument('--out', default='analytics.json',
+        help='Where to write the results.')
+    parser.add_argument('--workers', '-w', type=int,
+        help='The number of processes. Defaults to the number of CPUs.')
+    parser.add_argument('--chunk-size', default=50, type=int,
+        help='The number of pieces each worker counts at a time.')
+    args = parser.parse_args()
+
+    start = time.time()
+    total = analyze(args.output, args.workers, args.chunk_size)
+    seconds = time.time() - start
+
+    with open(args.out, 'w') as f:
+        json.dump(total, f, indent=2, sort_keys=True)
+
+    print 'Counted {} pieces in {:.2f} seconds. Wrote {}'.format(total['n_pieces'], seconds, args.out)
+    for path, error in sorted(total['failed'].items()):
+        print 'Could not load {}: {}'.format(path, error)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""Compact binary backups of pieces.
+
+A backup only holds what can't be worked out again: the score, the
+ensemble and the seed. `Grid.load` remakes everything else by adding the
+events of the score again.
+
+Version 1 of the format:
+
+    3 bytes     'HMH'
+    1 byte      the version
+    the rest, zlib compressed:
+        uint32  the length of the header
+        header  JSON with the ensemble, n_events and the seed
+        uint16  a code for every musician in every event, event by event,
+                in `musicians_score_order`
+
+A code is 0 when the musician isn't in the event, STOP when they stop, or
+PITCHES with the 12-bit pitch-class mask of their pitches (see
+harmony_utils). Integers are little-endian.
+
+Old pieces were saved as the whole `Grid.__dict__` in backup.json. Convert
+them with:
+
+    ./backup.py migrate
+    ./backup.py benchmark
+
+"""
+
+import os
+import json
+import glob
+import time
+import struct
+import zlib
+from argparse import ArgumentParser
+
+from harmony_utils import to_mask, from_mask
+
+
+MAGIC = 'HMH'
+VERSION = 1
+
+STOP = 0x1000
+PITCHES = 0x2000
+
+file_name = 'backup.hmh'
+json_file_name = 'backup.json'
+
+header_keys = [
+    'musicians',
+    'musicians_score_order',
+    'soloist',
+    'non_soloist_starters',
+    'n_events',
+    'seed',
+]
+
+
+class BackupError(Exception):
+    pass
+
+
+def dumps(d):
+    """Make a backup of the piece in `d`, as from `Grid.to_dict`."""
+    header = {key: d[key] for key in header_keys if key in d}
+    header = json.dumps(header, separators=(',', ':'))
+
+    order = d['musicians_score_order']
+    codes = []
+    for event in d['score']:
+        for name in order:
+            action = event.get(name)
+            if action is None:
+                codes.append(0)
+            elif action == 'stop':
+                codes.append(STOP)
+            else:
+                codes.append(PITCHES | to_mask(action))
+
+    body = struct.pack('<I', len(header)) + header + struct.pack('<{}H'.format(len(codes)), *codes)
+    return MAGIC + chr(VERSION) + zlib.compress(body, 9)
+
+
+def loads(data):
+    """Give the header of a backup, with the score under 'score'."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise BackupError('Not a backup')
+    version = ord(data[len(MAGIC)])
+    if version != VERSION:
+        raise BackupError('Unknown backup version {}'.format(version))
+
+    body = zlib.decompress(data[len(MAGIC) + 1:])
+    header_length, = struct.unpack_from('<I', body)
+    header_end = 4 + header_length
+    d = json.loads(body[4:header_end])
+
+    order = d['musicians_score_order']
+    n_codes = (len(body) - header_end) // 2
+    codes = struct.unpack_from('<{}H'.format(n_codes), body, header_end)
+
+    score = []
+    for start in range(0, n_codes, len(order)):
+        event = {}
+        for name, code in zip(order, codes[start:start + len(order)]):
+            if code == STOP:
+                event[name] = 'stop'
+            elif code & PITCHES:
+                event[name] = list(from_mask(code & ~PITCHES))
+        score.append(event)
+    d['score'] = score
+
+    return d
+
+
+def write(path, d):
+    backup_path = os.path.join(path, file_name)
+    with open(backup_path, 'wb') as f:
+        f.write(dumps(d))
+    return backup_path
+
+
+def read(path):
+    with open(os.path.join(path, file_name), 'rb') as f:
+        return loads(f.read())
+
+
+def read_json(path):
+    """Read an old backup.json. Only the score and the header are kept."""
+    with open(os.path.join(path, json_file_name), 'r') as f:
+        d = json.load(f)
+    return {key: d[key] for key in header_keys + ['score'] if key in d}
+
+
+def get_backup_path(path):
+    """The backup `Grid.load` would read, or None if the piece has none."""
+    for name in [file_name, json_file_name]:
+        backup_path = os.path.join(path, name)
+        if os.path.exists(backup_path):
+            return backup_path
+
+
+def get_piece_paths(output_path='output'):
+    return sorted(glob.glob(os.path.join(output_path, 'house_*')))
+
+
+def migrate(output_path='output', delete=False):
+    """Write a compact backup next to every backup.json that lacks one.
+
+    Each new backup is read back and checked against the JSON before the
+    JSON is deleted.
+
+    """
+    migrated = 0
+    failed = []
+    for path in get_piece_paths(output_path):
+        if not os.path.exists(os.path.join(path, json_file_name)):
+            continue
+
+        if not os.path.exists(os.path.join(path, file_name)):
+            write(path, read_json(path))
+            migrated += 1
+
+        if read(path) != read_json(path):
+            failed.append(path)
+            continue
+
+        if delete:
+            os.remove(os.path.join(path, json_file_name))
+
+    print 'Migrated {} backups'.format(migrated)
+    for path in failed:
+        print 'Kept {}: its backup.json has things the compact backup can not hold'.format(path)
+
+
+def benchmark(output_path='output'):
+    """Compare the size and speed of both formats on the saved pieces."""
+    from grid import Grid
+
+    paths = [path for path in get_piece_paths(output_path)
+             if os.path.exists(os.path.join(path, json_file_name))]
+    grids = []
+    for path in paths:
+        grid = Grid()
+        grid.load(path)
+        grids.append(grid)
+
+    results = []
+
+    # The old format: the whole __dict__, counters written out element by element
+    start = time.time()
+    json_strings = []
+    for grid in grids:
+        d = grid.to_dict()
+        for key in grid.counters:
+            d[key] = list(d[key].elements())
+        json_strings.append(json.dumps(d))
+    save_time = time.time() - start
+    start = time.time()
+    for json_string in json_strings:
+        Grid().from_dict(json.loads(json_string))
+    load_time = time.time() - start
+    results.append(('backup.json', sum(len(s) for s in json_strings), save_time, load_time))
+
+    start = time.time()
+    backups = [dumps(grid.to_dict()) for grid in grids]
+    save_time = time.time() - start
+    start = time.time()
+    for data in backups:
+        Grid().from_dict(loads(data))
+    load_time = time.time() - start
+    results.append((file_name, sum(len(b) for b in backups), save_time, load_time))
+
+    print '{} pieces'.format(len(grids))
+    print '{:<12} {:>12} {:>10} {:>10}'.format('format', 'bytes', 'save (s)', 'load (s)')
+    for name, size, save_time, load_time in results:
+        print '{:<12} {:>12} {:>10.3f} {:>10.3f}'.format(name, size, save_time, load_time)
+
+
+def cli():
+    parser = ArgumentParser(description='Compact backups of pieces')
+    parser.add_argument('command', choices=['migrate', 'benchmark'])
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with the house_* pieces.')
+    parser.add_argument('--delete-json', action='store_true',
+        help='Delete each backup.json once its compact backup is checked.')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(args.output, delete=args.delete_json)
+    else:
+        benchmark(args.output)
+
+
+if __name__ == '__main__':
+    cli()
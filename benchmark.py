@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""Benchmarks of making pieces, with fixed seeds, saved as JSON.
+
+    ./benchmark.py                      run and save to benchmarks/
+    ./benchmark.py --compare OLD.json   and show the change from OLD.json
+
+Microbenchmarks time `find_all_supersets` and `is_allowed` on fixed
+random chords. `Piece.get_harmony_options`, `Piece.pick_harmony` and
+`Grid.add_event` are timed call by call while the pieces are made.
+
+For each ensemble, pieces are made with seeds 0 to --seeds, giving events
+per second and retries per event, then `Runner.get_piece` is timed for
+pieces accepted per minute. Each ensemble runs in its own process, so its
+peak memory can be measured.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import datetime
+import functools
+import platform
+import resource
+import tempfile
+import traceback
+import subprocess
+from collections import defaultdict
+from multiprocessing import Process, Queue
+from argparse import ArgumentParser
+
+from harmony_utils import find_all_supersets, is_allowed
+from criteria import Rejected
+from failures import RetriesExhausted
+
+
+timed_methods = [
+    ('feb3', 'Piece', 'get_harmony_options'),
+    ('feb3', 'Piece', 'pick_harmony'),
+    ('grid', 'Grid', 'add_event'),
+]
+
+
+class Silence(object):
+    """Hide what's printed while making pieces."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def time_calls(f, args_list, repeat=3):
+    """The best time per call of `f` over `args_list`, in microseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for args in args_list:
+            f(*args)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best / len(args_list) * 1e6
+
+
+def run_micro(n=20000):
+    rng = random.Random(0)
+    subsets = [(sorted(rng.sample(range(12), rng.randint(1, 4))),) for _ in range(n)]
+    chords = [(tuple(sorted(rng.sample(range(12), rng.randint(1, 7)))),) for _ in range(n)]
+    return {
+        'find_all_supersets_us': time_calls(find_all_supersets, subsets),
+        'is_allowed_us': time_calls(is_allowed, chords),
+    }
+
+
+def wrap(timings, cls, name):
+    f = getattr(cls, name)
+
+    # Keep the name, which Runner.try_f counts failures and budgets by
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            timings[name].append(time.time() - start)
+
+    setattr(cls, name, timed)
+    return f
+
+
+def run_ensemble(quentin, seeds, n_events, n_accepted):
+    """Benchmark making pieces for one ensemble. Meant to run in its own process."""
+    import feb3
+    import grid
+    from run import Runner
+
+    results = {}
+
+    # Piece by piece, with the methods timed call by call
+    timings = defaultdict(list)
+    originals = []
+    for module, cls, name in timed_methods:
+        cls = getattr({'feb3': feb3, 'grid': grid}[module], cls)
+        originals.append((cls, name, wrap(timings, cls, name)))
+
+    n_made = 0
+    n_failed = 0
+    total_events = 0
+    retries = 0
+    start = time.time()
+    with Silence():
+        for seed in seeds:
+            runner = Runner()
+            try:
+                piece = runner.make_piece(n_events=n_events, quentin=quentin, seed=seed)
+                n_made += 1
+                total_events += len(piece.score)
+            except (Rejected, RetriesExhausted):
+                n_failed += 1
+            retries += sum(runner.exception_counter.values())
+    seconds = time.time() - start
+
+    for cls, name, f in originals:
+        setattr(cls, name, f)
+
+    results['pieces_made'] = n_made
+    results['pieces_failed'] = n_failed
+    results['events'] = total_events
+    results['events_per_second'] = total_events / seconds
+    results['retries_per_event'] = float(retries) / max(total_events, 1)
+    for name, times in sorted(timings.items()):
+        results['{}_us'.format(name)] = sum(times) / len(times) * 1e6 if times else None
+        results['{}_calls'.format(name)] = len(times)
+
+    # Whole runs of get_piece, saving to a temporary directory
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    os.mkdir('output')
+    start = time.time()
+    try:
+        with Silence():
+            runner = Runner(seed=seeds[0])
+            for _ in range(n_accepted):
+                runner.get_piece(n_events=n_events, quentin=quentin)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    results['accepted_per_minute'] = n_accepted / (time.time() - start) * 60
+
+    # Kilobytes on Linux
+    results['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def _run_ensemble_in_process(queue, args):
+    try:
+        queue.put(run_ensemble(*args))
+    except Exception:
+        # Recorded, so a broken ensemble doesn't stop the other
+        queue.put({'error': traceback.format_exc().splitlines()[-1]})
+
+
+def get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(n_seeds=30, n_events=40, n_accepted=5):
+    seeds = range(n_seeds)
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'settings': {'seeds': n_seeds, 'events': n_events, 'accepted': n_accepted},
+        'micro': run_micro(),
+        'ensembles': {},
+    }
+    for name, quentin in [('default', False), ('quentin', True)]:
+        queue = Queue()
+        process = Process(target=_run_ensemble_in_process, args=(queue, (quentin, seeds, n_events, n_accepted)))
+        process.start()
+        results['ensembles'][name] = queue.get()
+        process.join()
+    return results
+
+
+def flatten(results):
+    flat = {}
+    for name, value in results['micro'].items():
+        flat['micro.' + name] = value
+    for ensemble, values in results['ensembles'].items():
+        for name, value in values.items():
+            flat['{}.{}'.format(ensemble, name)] = value
+    return flat
+
+
+def report(results, old=None):
+    flat = flatten(results)
+    old_flat = flatten(old) if old else {}
+    for name in sorted(flat):
+        value = flat[name]
+        if isinstance(value, basestring):
+            print '{:<40} {}'.format(name, value)
+            continue
+        line = '{:<40} {:>14}'.format(name, '{:.3f}'.format(value) if isinstance(value, float) else value)
+        old_value = old_flat.get(name)
+        if isinstance(old_value, (int, float)) and old_value and value is not None:
+            line += '   {:+.1f}%'.format((value - old_value) * 100.0 / old_value)
+        print line
+
+
+def cli():
+    parser = ArgumentParser(description='Benchmark making pieces with fixed seeds')
+    parser.add_argument('--seeds', '-s', default=30, type=int,
+        help='The number of seeds to make pieces with, for each ensemble.')
+    parser.add_argument('--events', '-e', default=40, type=int,
+        help='The number of events of each piece.')
+    parser.add_argument('--accepted', '-a', default=5, type=int,
+        help='The number of pieces to get from Runner.get_piece for each ensemble.')
+    parser.add_argument('--out', '-o',
+        help='Where to save the results. Defaults to benchmarks/<date>.json')
+    parser.add_argument('--compare', '-c',
+        help='Earlier results to compare with.')
+    args = parser.parse_args()
+
+    results = run_all(args.seeds, args.events, args.accepted)
+
+    out = args.out
+    if not out:
+        if not os.path.exists('benchmarks'):
+            os.mkdir('benchmarks')
+        out = os.path.join('benchmarks', '{}.json'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    old = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+    report(results, old)
+    print 'Wrote {}'.format(out)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Time starting run.py and making a piece without rendering it.
+
+Each case runs in a new Python process. The eager cases also import the
+notation backends first, like run.py did before they were only imported
+for -n and -p, so the two can be compared:
+
+    ./benchmark_startup.py --runs 10
+
+"""
+
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser
+
+
+eager = 'import notate_score; '
+
+cases = [
+    ('import', 'import run'),
+    ('generate', 'import run; run.Runner().make_piece({events}, seed=0)'),
+]
+
+
+def time_code(code, runs):
+    """Give the times of `runs` processes running `code`, or None if it fails."""
+    times = []
+    with open('/dev/null', 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            returncode = subprocess.call([sys.executable, '-c', code], stdout=devnull, stderr=devnull)
+            if returncode:
+                return None
+            times.append(time.time() - start)
+    return times
+
+
+def cli():
+    parser = ArgumentParser(description='Time run.py startup with and without importing music21')
+    parser.add_argument('--runs', '-r', default=5, type=int,
+        help='The number of processes to time for each case.')
+    parser.add_argument('--events', '-e', default=40, type=int,
+        help='The number of events of the generated piece.')
+    args = parser.parse_args()
+
+    print '{:<10} {:>12} {:>12}'.format('case', 'lazy (s)', 'eager (s)')
+    for name, code in cases:
+        code = code.format(events=args.events)
+        results = []
+        for prefix in ['', eager]:
+            times = time_code(prefix + code, args.runs)
+            if times is None:
+                results.append('failed')
+            else:
+                results.append('{:.3f}'.format(min(times)))
+        print '{:<10} {:>12} {:>12}'.format(name, *results)
+
+    print '(the fastest of {} runs. Eager fails if music21 is not installed)'.format(args.runs)
+
+
+if __name__ == '__main__':
+    cli()
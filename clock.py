@@ -0,0 +1,59 @@
+"""A clock for deadlines and timings that doesn't jump with the system time.
+
+Python 2 has no `time.monotonic`, so on Linux and macOS `monotonic` reads
+CLOCK_MONOTONIC with clock_gettime through ctypes. Where that can't be
+found it falls back to `time.time`, which is not monotonic: a deadline can
+then move when the system time is changed. `is_monotonic` tells which.
+
+>>> a = monotonic()
+>>> monotonic() >= a
+True
+
+"""
+
+import sys
+import time
+
+
+def _get_clock_gettime():
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # CLOCK_MONOTONIC is 1 on Linux and 6 on macOS
+    clock_id = 6 if sys.platform == 'darwin' else 1
+
+    for name in ['c', 'rt']:
+        path = ctypes.util.find_library(name)
+        if not path:
+            continue
+        library = ctypes.CDLL(path, use_errno=True)
+        if not hasattr(library, 'clock_gettime'):
+            continue
+        clock_gettime = library.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(clock_id, ctypes.byref(t)):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+
+
+try:
+    from time import monotonic
+    is_monotonic = True
+except ImportError:
+    # Python 2
+    try:
+        monotonic = _get_clock_gettime()
+    except (ImportError, OSError, AttributeError):
+        monotonic = None
+    is_monotonic = monotonic is not None
+    if not monotonic:
+        monotonic = time.time
@@ -0,0 +1,174 @@
+"""Rules a piece has to follow to be kept.
+
+Rules are a dict, and can be loaded from a JSON file like this one:
+
+    {
+        "min_gaps": 1,
+        "min_solos": {"Kristin": 1},
+        "min_density": {"5": 3, "6": 2},
+        "max_density": {"1": 5}
+    }
+
+Density rules are about the number of states with that many musicians
+playing.
+
+"""
+
+import json
+
+
+default_rules = {
+    # - at least one gap
+    'min_gaps': 1,
+
+    # - at least one solo for Kristin
+    'min_solos': {'Kristin': 1},
+
+    # - at least 3 states where five people are playing
+    # - at least 2 states where six people are playing
+    'min_density': {5: 3, 6: 2},
+
+    # - no more than 5 solos
+    'max_density': {1: 5},
+}
+
+rule_names = ['min_gaps', 'min_solos', 'min_density', 'max_density']
+
+
+class Rejected(Exception):
+    """The piece being made can no longer follow the rules."""
+
+
+def load_rules(path):
+    with open(path, 'r') as f:
+        return parse_rules(json.load(f), path)
+
+
+def parse_rules(rules, source='the rules'):
+    """Check rules read from JSON and give them their integer keys back."""
+    unknown = [name for name in rules if name not in rule_names]
+    if unknown:
+        raise ValueError('Unknown rules in {}: {}'.format(source, ', '.join(unknown)))
+
+    # JSON keys are always strings
+    for name in ['min_density', 'max_density']:
+        if name in rules:
+            rules[name] = {int(density): n for density, n in rules[name].items()}
+
+    return rules
+
+
+class Criteria(object):
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = default_rules
+        self.rules = rules
+        self.min_gaps = rules.get('min_gaps', 0)
+        self.min_solos = rules.get('min_solos', {})
+        self.min_density = rules.get('min_density', {})
+        self.max_density = rules.get('max_density', {})
+
+    def is_good(self, piece):
+        """Check a finished piece, after `Piece.run` has counted everything."""
+        if piece.gaps < self.min_gaps:
+            return False
+
+        for name, n in self.min_solos.items():
+            if piece.solos[name] < n:
+                return False
+
+        for density, n in self.min_density.items():
+            if piece.density[density] < n:
+                return False
+
+        for density, n in self.max_density.items():
+            if piece.density[density] > n:
+                return False
+
+        return True
+
+    def check_ensemble(self, musicians):
+        """Raise ValueError if the rules name musicians who aren't in the ensemble."""
+        unknown = sorted(name for name in self.min_solos if name not in musicians)
+        if unknown:
+            raise ValueError('min_solos names musicians who aren\'t in the ensemble: {}'.format(', '.join(unknown)))
+
+    def monitor(self):
+        return CriteriaMonitor(self)
+
+
+class CriteriaMonitor(object):
+    """Follow a piece as it's made and reject it once it can't be good.
+
+    `update` is called by `Grid.add_event` after every event. It raises
+    `Rejected` when a maximum has been passed, or when there aren't enough
+    events left to reach a minimum.
+
+    """
+    def __init__(self, criteria):
+        self.criteria = criteria
+
+    def update(self, grid):
+        reason = self.get_broken_rule(grid)
+        if reason:
+            raise Rejected(reason)
+
+    def undo(self, grid):
+        # Nothing to take back. The counts are the grid's own.
+        pass
+
+    def get_broken_rule(self, grid):
+        for density, n in self.criteria.max_density.items():
+            if grid.density[density] > n:
+                return 'More than {} states with {} playing'.format(n, density)
+
+        if grid.n >= 4 and grid.n_events - len(grid.score) <= len(grid.musicians):
+            return self.get_broken_rule_in_end_game(grid)
+
+        # The most states there could still be: the rest of the events, then
+        # at most one more per musician while they all stop
+        remaining = max(grid.n_events - len(grid.score), 0) + len(grid.musicians)
+
+        # The newest harmony is a gap too if it's empty and isn't the end
+        newest_is_empty = not grid.previous_harmony
+        if grid.gaps + newest_is_empty + remaining < self.criteria.min_gaps:
+            return 'Not enough events left for {} gaps'.format(self.criteria.min_gaps)
+
+        for name, n in self.criteria.min_solos.items():
+            if grid.solos[name] + remaining < n:
+                return 'Not enough events left for {} solos by {}'.format(n, name)
+
+        for density, n in self.criteria.min_density.items():
+            if grid.density[density] + remaining < n:
+                return 'Not enough events left for {} states with {} playing'.format(n, density)
+
+    def get_broken_rule_in_end_game(self, grid):
+        """Check the minimums once nobody new can start playing.
+
+        In the end game (see `Piece.get_changing_musicians`) every event
+        stops some of the musicians playing, so each state to come has
+        fewer playing than the one before, down to none at the end. There
+        are no more gaps, at most one more state with each number playing
+        below the number playing now, and at most one more solo, by one of
+        them.
+
+        """
+        playing = [name for name in grid.musicians_score_order if grid.previous_state.get(name)]
+
+        if grid.gaps < self.criteria.min_gaps:
+            return 'No gaps can come for {} gaps'.format(self.criteria.min_gaps)
+
+        missing_solos = 0
+        for name, n in self.criteria.min_solos.items():
+            if grid.solos[name] >= n:
+                continue
+            missing_solos += n - grid.solos[name]
+            if name not in playing or len(playing) < 2:
+                return 'No solo by {} can come for {} solos'.format(name, n)
+        if missing_solos > 1:
+            return 'Only one more solo can come, and {} are needed'.format(missing_solos)
+
+        for density, n in self.criteria.min_density.items():
+            still_to_come = 1 if density < len(playing) else 0
+            if grid.density[density] + still_to_come < n:
+                return 'Not enough states left for {} states with {} playing'.format(n, density)
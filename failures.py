@@ -0,0 +1,60 @@
+"""Ways a random process making a piece can fail and be worth retrying.
+
+`Runner.try_f` retries a function when it raises one of these, and counts
+them by function and type. Anything else is a bug and isn't caught.
+
+"""
+
+
+class GenerationFailure(Exception):
+    reason = 'Generation failed'
+
+    # Whether trying again with the same arguments could work
+    retry = True
+
+    def __init__(self, *args):
+        Exception.__init__(self, *(args or [self.reason]))
+
+
+class NoEligibleMusicians(GenerationFailure):
+    reason = 'No one is eligible to change.'
+
+
+class DisallowedHoldover(GenerationFailure):
+    reason = 'Pitches dropped out, no new pitches are coming in, and the harmony left behind is not allowed'
+
+
+class OnlyPreviousHarmony(GenerationFailure):
+    reason = 'Only harmony option is the previous harmony'
+
+
+class CapacityExceeded(GenerationFailure):
+    reason = 'All harmony options had more new pitches than instruments could play'
+
+    # The options are filtered by capacity before they're passed in, so
+    # there's nothing left to try
+    retry = False
+
+
+class UnassignablePitches(GenerationFailure):
+    reason = 'Couldnt give all new pitches to entering instruments'
+
+
+class UnfilledInstruments(GenerationFailure):
+    reason = 'Couldnt fill all entering instruments'
+
+
+class RetriesExhausted(GenerationFailure):
+    """A function failed every attempt it had, or time ran out."""
+    reason = 'Ran out of retries'
+
+    def __init__(self, function, attempts, timed_out, last_failure):
+        self.function = function
+        self.attempts = attempts
+        self.timed_out = timed_out
+        self.last_failure = last_failure
+
+        msg = 'Tried {} {} times. Exception: {}'.format(function, attempts, last_failure)
+        if timed_out:
+            msg += ' Timed out.'
+        GenerationFailure.__init__(self, msg)
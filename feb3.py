@@ -1,9 +1,16 @@
 import random
-from collections import Counter, defaultdict
+import logging
+from collections import defaultdict
 
 from utils import weighted_choice_lists, weighted_choice_dict
-from harmony_utils import is_allowed, find_all_supersets
+from harmony_utils import is_allowed, find_all_supersets, to_mask
 from grid import Grid
+from profiling import timed
+from failures import (RetriesExhausted, NoEligibleMusicians, DisallowedHoldover, OnlyPreviousHarmony,
+                      CapacityExceeded, UnassignablePitches, UnfilledInstruments)
+
+
+log = logging.getLogger(__name__)
 
 
 def funny_range(steps, top, bottom):
@@ -16,13 +23,35 @@ def funny_range(steps, top, bottom):
     return [top - (interval * step) for step in range(steps)]
 
 
+def get_capacities(max_notes):
+    """The most pitches every subset of musicians can play together.
+
+    Indexed by the bit mask of the subset, bit i being the musician with
+    `max_notes[i]`.
+
+    >>> get_capacities([1, 2, 10])
+    [0, 1, 2, 3, 10, 11, 12, 13]
+
+    """
+    capacities = [0]
+    for n in max_notes:
+        capacities += [capacity + n for capacity in capacities]
+    return capacities
+
+
 class Piece(Grid):
-    def __init__(self, runner, n_events=40, quentin=False):
+    def __init__(self, runner, n_events=40, quentin=False, seed=None):
         self.try_f = runner.try_f
+        self.backtrack = runner.backtrack
+        self.undoable = runner.undoable
 
         self.n_events = n_events
         self.done = False
-        self.n = 0
+
+        # Every choice made for the piece comes from `self.random`, so the
+        # same seed makes the same piece again
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.random = random.Random(self.seed)
 
         self.musicians = {
             'Andrea': {
@@ -111,23 +140,22 @@ class Piece(Grid):
 
         self.instrument_names = [self.musicians[name]['instrument'] for name in self.musicians_score_order]
 
-        self.score = []
-        self.grid = {name: [] for name in self.musicians}
+        self._musician_bits = {name: 1 << i for i, name in enumerate(self.musicians_score_order)}
+        self.capacities = get_capacities([self.musicians[name]['max_notes'] for name in self.musicians_score_order])
 
-        # `reality` Needs a better variable name
-        # This contains all the things happening between events
-        self.reality = []
-        self.harmonies = []
-
-        # Keep one or the other of these counters. pitchclass_count is a newer implementation and probably more correct.
-        self.pitchclass_count = Counter()
-        self.pc_counter = Counter()
+        self._reset()
 
         self._event_generator = self._get_event_generator()
 
     def _get_event_generator(self):
         while True:
-            event = self.try_f(self.make_event)
+            try:
+                event = self.try_f(self.make_event)
+            except RetriesExhausted:
+                # Dead end. Undo the last few events and try again from there.
+                if not self.backtrack(self):
+                    raise
+                continue
             if event:
                 self.add_event(event)
             yield event
@@ -135,17 +163,30 @@ class Piece(Grid):
     def next(self):
         return self._event_generator.next()
 
+    def events(self):
+        """Make the piece, giving each event as soon as it can't be undone.
+
+        Gives a `StreamedEvent` for every event of the score, in order.
+        Backtracking can undo the last few events, so events come out once
+        the runner has too few backtracks left to reach them.
+
+        """
+        n_given = 0
+        while not self.done:
+            self.next()
+            n_final = len(self.score)
+            if not self.done:
+                n_final -= self.undoable(self)
+            while n_given < n_final:
+                yield self.get_streamed_event(n_given)
+                n_given += 1
+
     def run(self, n_events=None):
         if not n_events:
             n_events = self.n_events
         while not self.done:
             self.next()
 
-        self.count_gaps()
-        self.count_tutti()
-        self.count_solos()
-        self.report_density()
-
     def make_event(self):
         # Choose which musicians will start and stop playing. Get the set of
         # pitches that will sustain from the previous state.
@@ -156,6 +197,8 @@ class Piece(Grid):
 
         event = {}
         if entering:
+            harmony_options = self.filter_by_capacity(harmony_options, entering, holdover_pitches)
+
             # Pick a harmony and which instruments will play any new pitches
             # event = self.pick_harmony(entering, harmony_options, holdover_pitches)
             event = self.try_f(self.pick_harmony, args=[entering, harmony_options, holdover_pitches])
@@ -172,10 +215,11 @@ class Piece(Grid):
         holdover_pitches = self.get_holdover_pitches(changing)
 
         if not entering and not is_allowed(holdover_pitches):
-            raise Exception('Pitches dropped out, no new pitches are coming in, and the harmony left behind is not allowed')
+            raise DisallowedHoldover()
 
         return entering, exiting, holdover_pitches
 
+    @timed('harmony_options')
     def get_harmony_options(self, holdover_pitches):
         if holdover_pitches:
             harmony_options = find_all_supersets(holdover_pitches)
@@ -187,11 +231,11 @@ class Piece(Grid):
             # print 'new seed', new_seed
             harmony_options = find_all_supersets([new_seed])
 
-        if self.harmonies and self.harmonies[-1] in harmony_options:
-            harmony_options.remove(self.harmonies[-1])
+        if self.n and self.previous_harmony in harmony_options:
+            harmony_options.remove(self.previous_harmony)
 
         if not harmony_options:
-            raise Exception('Only harmony option is the previous harmony')
+            raise OnlyPreviousHarmony()
 
         # Make weights
         harmony_options.reverse()
@@ -200,54 +244,70 @@ class Piece(Grid):
         # Put options and weights into a dictionary
         harmony_options = {opt: weight for opt, weight in zip(harmony_options, harmony_weights)}
 
-        # Reduce repetitions of harmonies
-        for h in self.harmonies:
-            h = tuple(h)
-            if h in harmony_options:
-                harmony_options[h] = harmony_options[h] / 2.0
-
-        # Reduce repetitions of pitch classes
+        # Reduce repetitions of pitch classes: the most used pitch classes
+        # divide the weights of harmonies containing them the most
         count_of_pitchclasses_used = len(self.pitchclass_count)
         weights_to_reduce = funny_range(count_of_pitchclasses_used, 12.0, 4.0)
-        for pc_and_count, weight in zip(self.pitchclass_count.most_common(), weights_to_reduce):
-            pc, count = pc_and_count
-            for h in harmony_options:
-                if pc in h:
-                    h = tuple(h)
-                    harmony_options[h] = harmony_options[h] / float(weight)
+        reductions = [(1 << pc, float(weight)) for (pc, count), weight in
+                      zip(self.pitchclass_count.most_common(), weights_to_reduce)]
+
+        for h in harmony_options:
+            weight = harmony_options[h]
+
+            # Reduce repetitions of harmonies: halve the weight for each time
+            # the harmony has already happened
+            repetitions = self.harmony_count[h]
+            if repetitions:
+                weight = weight / 2.0 ** repetitions
+
+            mask = to_mask(h)
+            for pc_bit, reduction in reductions:
+                if mask & pc_bit:
+                    weight = weight / reduction
+
+            harmony_options[h] = weight
 
         return harmony_options
 
-    def pick_harmony(self, entering, harmony_options, holdover_pitches):
-        # The total number of pitches the ensemble of entering musicians can play
-        total_max_notes = sum([self.musicians[name]['max_notes'] for name in entering])
+    def filter_by_capacity(self, harmony_options, entering, holdover_pitches):
+        """Keep the harmony options with no more new pitches than `entering` can play.
 
-        # Choose a new harmony
-        new_harmony = weighted_choice_dict(harmony_options)
-        new_pitches = [p for p in new_harmony if p not in holdover_pitches]
+        Choosing from what's left by weight is the same as choosing from
+        all of them and choosing again until one fits.
 
-        # If there are more new pitches than the ensemble of musicians can play
-        # then refine the available options and weights and choose another harmony
-        while len(new_pitches) > total_max_notes:
+        """
+        mask = 0
+        for name in entering:
+            mask |= self._musician_bits[name]
 
-            # So don't allow this harmony to be chosen again
-            if new_harmony in harmony_options:
-                del harmony_options[new_harmony]
+        # Every option holds all of the holdover pitches
+        max_size = self.capacities[mask] + len(holdover_pitches)
+        if max_size >= 12:
+            return harmony_options
+        return {h: weight for h, weight in harmony_options.items() if len(h) <= max_size}
 
-            # If all the harmonies have been tried and they all have more new
-            # pitches than the ensemble can play, then raise an exception
-            # and try with a new set of harmony options
-            if not harmony_options:
-                raise Exception('All harmony options had more new pitches than instruments could play')
+    @timed('pick_harmony')
+    def pick_harmony(self, entering, harmony_options, holdover_pitches):
+        # No option has few enough new pitches for the entering musicians
+        # (see `filter_by_capacity`)
+        if not harmony_options:
+            raise CapacityExceeded()
 
-            # Choose a new harmony from the options
-            new_harmony = weighted_choice_dict(harmony_options)
-            new_pitches = [p for p in new_harmony if p not in holdover_pitches]
+        # Choose a new harmony
+        new_harmony = weighted_choice_dict(harmony_options, self.random)
+        new_pitches = [p for p in new_harmony if p not in holdover_pitches]
 
         # Assign the new pitches to instruments
         pitches = {name: [] for name in entering}
+        n = 0
         while new_pitches:
-            name = random.choice(entering)
+            n += 1
+            if n > 1000:
+                # Everyone is full, except maybe a cello that can't play
+                # any of the new pitches as a fifth
+                raise UnassignablePitches()
+
+            name = self.random.choice(entering)
 
             # When cello plays two notes, it should be a fifth
             # TODO: Make work when Rachel isn't playing :)
@@ -257,18 +317,18 @@ class Piece(Grid):
                 target_pitches = [(existing_pitch + 7) % 12, (existing_pitch + 5) % 12]
                 target_pitches = [t for t in target_pitches if t in new_pitches]
                 if target_pitches:
-                    p = random.choice(target_pitches)
+                    p = self.random.choice(target_pitches)
                     pitches[name].append(p)
                     new_pitches.remove(p)
                     continue
                 else:
                     if len(entering) == 1:
-                        p = random.choice(new_pitches)
+                        p = self.random.choice(new_pitches)
                         if len(pitches[name]) < self.musicians[name]['max_notes']:
                             pitches[name].append(p)
                             new_pitches.remove(p)
             else:
-                p = random.choice(new_pitches)
+                p = self.random.choice(new_pitches)
                 if len(pitches[name]) < self.musicians[name]['max_notes']:
                     pitches[name].append(p)
                     new_pitches.remove(p)
@@ -278,14 +338,14 @@ class Piece(Grid):
         while not all(pitches.values()):
             n += 1
             empty = [name for name in pitches if not pitches[name]]
-            name = random.choice(empty)
-            p = random.choice(new_harmony)
+            name = self.random.choice(empty)
+            p = self.random.choice(new_harmony)
             pitches[name].append(p)
             if n > 1000:
-                raise Exception('Couldnt fill all entering instruments')
+                raise UnfilledInstruments()
 
         # Add some extra notes
-        if random.random() < 0.7:
+        if self.random.random() < 0.7:
             headroom = {name: self.musicians[name]['max_notes'] - len(pitches[name]) for name in entering}
             for name in headroom:
 
@@ -297,7 +357,7 @@ class Piece(Grid):
                     target_pitches = [(existing_pitch + 7) % 12, (existing_pitch + 5) % 12]
                     target_pitches = [t for t in target_pitches if t in new_harmony]
                     if target_pitches:
-                        p = random.choice(target_pitches)
+                        p = self.random.choice(target_pitches)
                         pitches[name].append(p)
                 else:
                     pitch_options = [p for p in new_harmony if p not in pitches[name]]
@@ -305,8 +365,8 @@ class Piece(Grid):
                     if upper:
                         n_pitches = 1
                         if upper > 1:
-                            n_pitches = random.randint(1, upper)
-                        ps = random.sample(pitch_options, n_pitches)
+                            n_pitches = self.random.randint(1, upper)
+                        ps = self.random.sample(pitch_options, n_pitches)
                         pitches[name].extend(ps)
 
         for name in pitches:
@@ -323,8 +383,9 @@ class Piece(Grid):
             pcs_by_count[count].append(pc)
 
         lowest_count = min(pcs_by_count.keys())
-        return random.choice(pcs_by_count[lowest_count])
+        return self.random.choice(pcs_by_count[lowest_count])
 
+    @timed('holdovers')
     def get_holdover_pitches(self, changing):
         # Get pitches that are sustaining from previous
         holdover_pitches = []
@@ -348,6 +409,7 @@ class Piece(Grid):
                 exiting.append(name)
         return entering, exiting
 
+    @timed('changers')
     def get_changing_musicians(self):
         if self.n == 0:
             return self.non_soloist_starters + [self.soloist]
@@ -375,20 +437,20 @@ class Piece(Grid):
                 n_musicians_opts = range(1, len(playing) + 1)
                 n_musicians_weights = list(reversed([2 ** n for n in n_musicians_opts]))
                 n_musicians_weights[0] = n_musicians_weights[1]
-                num_changing = weighted_choice_lists(n_musicians_opts, n_musicians_weights)
-                changing = random.sample(playing, num_changing)
+                num_changing = weighted_choice_lists(n_musicians_opts, n_musicians_weights, self.random)
+                changing = self.random.sample(playing, num_changing)
         else:
 
             eligible = self.get_eligible_to_change()
 
             if len(eligible) == 0:
-                raise Exception('No one is eligible to change.')
+                raise NoEligibleMusicians()
 
             if len(eligible) == 1:
                 changing = eligible
             else:
                 num_changing = self.choose_number_changing(eligible)
-                changing = random.sample(eligible, num_changing)
+                changing = self.random.sample(eligible, num_changing)
 
         return changing
 
@@ -398,7 +460,7 @@ class Piece(Grid):
         prev_event = {}
         if self.score:
             prev_event = self.score[-1]
-        not_eligible = [name for name in prev_event if prev_event[name] != 'stop' and random.random() < .95]
+        not_eligible = [name for name in prev_event if prev_event[name] != 'stop' and self.random.random() < .95]
 
         # The soloist should play through the first three events
         if 1 < self.n < 4:
@@ -411,7 +473,7 @@ class Piece(Grid):
                 # start now
                 if self.score[-1].get(name) is 'stop' and \
                         name not in not_eligible and \
-                        random.random() < .75:
+                        self.random.random() < .75:
                     not_eligible.append(name)
 
                 # If the instrument just started, make it less likely to
@@ -419,7 +481,7 @@ class Piece(Grid):
                 if self.score[-1].get(name) and \
                         self.score[-1].get(name) is not 'stop' and \
                         name not in not_eligible and \
-                        random.random() < .75:
+                        self.random.random() < .75:
                     not_eligible.append(name)
 
                 # If the instrument started then continued, make it less
@@ -428,14 +490,14 @@ class Piece(Grid):
                         self.score[-2].get(name) is not None and \
                         self.score[-2].get(name) is not 'stop' and \
                         name not in not_eligible and \
-                        random.random() < .6:
+                        self.random.random() < .6:
                     not_eligible.append(name)
 
                 # If the instrument didn't change (was resting or playing)
                 # in the last event, half the time they are inelligible
                 if name not in self.score[-1] and \
                         name not in not_eligible and \
-                        random.random() < .7:
+                        self.random.random() < .7:
                     not_eligible.append(name)
 
         eligible = [name for name in self.musicians_score_order if name not in not_eligible]
@@ -456,6 +518,6 @@ class Piece(Grid):
             n_musicians_weights[i] = 1
 
         # n_musicians_weights[0] = n_musicians_weights[1]
-        choice = weighted_choice_lists(n_musicians_opts, n_musicians_weights)
-        print 'n_musicians_opts:', n_musicians_opts, 'n_musicians_weights', n_musicians_weights, choice
+        choice = weighted_choice_lists(n_musicians_opts, n_musicians_weights, self.random)
+        log.debug('n_musicians_opts: %s n_musicians_weights %s %s', n_musicians_opts, n_musicians_weights, choice)
         return choice
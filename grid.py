@@ -1,104 +1,274 @@
 import os
+import sys
 import json
+import time
 import datetime
-from collections import Counter
+from array import array
+from collections import Counter, namedtuple
 
-from harmony_utils import get_all_transpositions, allowed_chord_types
-from notate_score import notate_score
-from write_notation_cell import write_notation_cell
+from harmony_utils import get_chord_types, to_mask, from_mask
+import backup
+from manifest import Manifest
+from profiling import timed
+from reports import Reports
+from write_notation_cell import write_musicxml, render_pngs, cache_settings
 
 
-note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+def get_new_path(output_path='output'):
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    return os.path.join(output_path, 'house_{}'.format(timestamp))
 
 
-def spell(chord):
-    return ' '.join([note_names[p] for p in chord])
+def _nonzero(counter):
+    return {key: n for key, n in counter.items() if n}
+
+
+def _decrement(counter, key):
+    _count(counter, key, -1)
+
+
+def _count(counter, key, change):
+    counter[key] += change
+    if not counter[key]:
+        # Leave the counter as if the key was never counted
+        del counter[key]
+
+
+# An event of a piece, with the state and harmony after it
+StreamedEvent = namedtuple('StreamedEvent', ['index', 'event', 'state', 'harmony'])
 
 
 class Grid(object):
-    dont_save = ['_event_generator', 'n', 'try_f']
+    """The state of a piece, event by event.
+
+    `score` is the list of events as they were made. Everything else is
+    kept compactly: the pitches each musician holds after each event are a
+    12-bit pitch-class mask (see harmony_utils), one row of masks per event
+    in `musicians_score_order` in the `array` `_pitch_masks`, and each
+    event's harmony is the OR of its row, in `_harmony_masks`.
+
+    `grid`, `reality` and `harmonies` are built from the masks when they're
+    asked for, for saving, and so is everything the reports show (see
+    reports.py). While making a piece, use
+    `previous_state` and `previous_harmony`, which only look at the last row.
+
+    """
+    dont_save = ['_event_generator', 'n', 'try_f', 'backtrack', 'undoable', 'random', 'harmony_count', 'monitors',
+                 '_pitch_masks', '_harmony_masks', '_views', '_previous_state', '_musician_bits', 'capacities']
     counters = ['pc_counter', 'pitchclass_count']
 
+    # Made from the masks. Saved for reading backups, but never loaded.
+    views = ['grid', 'reality', 'harmonies']
+
     def __repr__(self):
         return self.reports()
 
+    def _reset(self):
+        """Forget all events. `musicians_score_order` must already be set."""
+        self.n = 0
+        self.score = []
+
+        # `reality` (the masks) Needs a better variable name
+        # This contains all the things happening between events
+        self._pitch_masks = array('H')
+        self._harmony_masks = array('H')
+        self.harmony_count = Counter()
+
+        # Keep one or the other of these counters. pitchclass_count is a newer implementation and probably more correct.
+        self.pitchclass_count = Counter()
+        self.pc_counter = Counter()
+
+        # Statistics kept up to date as events are added. `count_gaps`,
+        # `count_tutti`, `count_solos` and `report_density` count the same
+        # things over the whole piece.
+        self.gaps = 0
+        self.tutti = 0
+        self.solos = Counter()
+        self.density = Counter()
+
+        # The number of states each musician plays in, and the number of
+        # times each one starts playing
+        self.playing_time = Counter()
+        self.entries = Counter()
+
+        # Things to tell about every event added, like `CriteriaMonitor`
+        self.monitors = []
+
+        self._views = {}
+        self._previous_state = None
+
     @property
     def previous_state(self):
-        if self.reality:
-            return self.reality[-1]
-        else:
-            return {name: [] for name in self.musicians_score_order}
+        if self._previous_state is None:
+            if self.n:
+                self._previous_state = self._get_state(self.n - 1)
+            else:
+                self._previous_state = {name: [] for name in self.musicians_score_order}
+        return self._previous_state
+
+    @property
+    def previous_harmony(self):
+        """The harmony after the last event, or None before the first."""
+        if self.n:
+            return from_mask(self._harmony_masks[-1])
 
+    @timed('add_event')
     def add_event(self, event):
         self.score.append(event)
         self.n += 1
 
-        for name in event:
-            self.grid[name].append(event[name])
-
-        not_changing = [name for name in self.musicians if name not in event]
-        for name in not_changing:
-            prev = []
-            if self.grid[name]:
-                prev = self.grid[name][-1]
-            if prev == 'stop':
-                prev = []
-            self.grid[name].append(prev)
-
-        # Extend reality :)
-        new_reality = self._get_new_reality(event)
-        self.reality.append(new_reality)
-
-        # Calculate new harmony and append to list of harmonies
-        previous_harmony = []
-        if self.harmonies:
-            previous_harmony = self.harmonies[-1]
-
-        harmony = []
-        for musician in new_reality:
-            pitches = new_reality[musician]
-            harmony.extend(pitches)
-        harmony = list(set(harmony))
-        harmony.sort()
-        harmony = tuple(harmony)
-        self.harmonies.append(harmony)
+        # Make the new row of the reality: the actual music being played
+        # between events.
+        width = len(self.musicians_score_order)
+        previous_row = len(self._pitch_masks) - width
+        harmony_mask = 0
+        for i, musician in enumerate(self.musicians_score_order):
+            action = event.get(musician)
+
+            if action == 'stop':
+                # Was playing ==> Stop ==> Do nothing
+                mask = 0
+            elif action:
+                # Was playing ==> New content ==> Add from event
+                # Wasn't playing ==> New content ==> Add from event
+                mask = to_mask(action)
+            elif previous_row >= 0:
+                # Was playing ==> Not in event ==> Add from previous reality
+                # Wasn't playing ==> Not in event ==> Do nothing
+                mask = self._pitch_masks[previous_row + i]
+            else:
+                mask = 0
+
+            self._pitch_masks.append(mask)
+            harmony_mask |= mask
+
+        previous_harmony_mask = 0
+        if self._harmony_masks:
+            previous_harmony_mask = self._harmony_masks[-1]
+        self._harmony_masks.append(harmony_mask)
+        self._previous_state = None
+        self._views = {}
+
+        self._count_newest_state(1)
+
+        harmony = from_mask(harmony_mask)
+        self.harmony_count[harmony] += 1
 
         for p in harmony:
             self.pc_counter[p] += 1
 
         # Count pitchclasses
-        new_pitchclasses = [p for p in harmony if p not in previous_harmony]
-        # print 'new_pitchclasses', new_pitchclasses
+        new_pitchclasses = from_mask(harmony_mask & ~previous_harmony_mask)
         # Increment pitch class counter
         for pitch in new_pitchclasses:
             self.pitchclass_count[pitch] += 1
 
-    def _get_new_reality(self, event):
-        # Make new reality: the actual music being played between events.
-        new_reality = {}
+        for monitor in self.monitors:
+            monitor.update(self)
 
-        previous_reality = {}
-        if len(self.reality):
-            previous_reality = self.reality[-1]
+    def undo_event(self):
+        """Take back the last event, as if it was never added."""
+        for monitor in self.monitors:
+            monitor.undo(self)
 
-        for musician in self.musicians_score_order:
-            previous = previous_reality.get(musician)
-            action = event.get(musician)
+        self._count_newest_state(-1)
 
-            if action and action is not 'stop':
-                # Was playing ==> New content ==> Add from event
-                # Wasn't playing ==> New content ==> Add from event
-                new_reality[musician] = action
+        harmony_mask = self._harmony_masks.pop()
+        previous_harmony_mask = 0
+        if self._harmony_masks:
+            previous_harmony_mask = self._harmony_masks[-1]
 
-            if previous and not action:
-                # Was playing ==> Not in event ==> Add from previous reality
-                new_reality[musician] = previous
+        harmony = from_mask(harmony_mask)
+        _decrement(self.harmony_count, harmony)
+        for p in harmony:
+            _decrement(self.pc_counter, p)
+        for p in from_mask(harmony_mask & ~previous_harmony_mask):
+            _decrement(self.pitchclass_count, p)
+
+        del self._pitch_masks[-len(self.musicians_score_order):]
+        self._previous_state = None
+        self._views = {}
+        self.score.pop()
+        self.n -= 1
+
+    def rollback(self, n_events):
+        """Undo events until there are only `n_events` left."""
+        while len(self.score) > n_events:
+            self.undo_event()
+
+    def _count_newest_state(self, change):
+        """Add the newest state to the statistics, or with -1, take it back."""
+        width = len(self.musicians_score_order)
+        row = (self.n - 1) * width
+        previous_row = row - width
+
+        playing = []
+        for i, musician in enumerate(self.musicians_score_order):
+            if self._pitch_masks[row + i]:
+                playing.append(musician)
+                _count(self.playing_time, musician, change)
+                if previous_row < 0 or not self._pitch_masks[previous_row + i]:
+                    _count(self.entries, musician, change)
+
+        _count(self.density, len(playing), change)
+
+        # The first state doesn't count for solos and tutti. This includes
+        # the soloists' solo in state #2
+        if self.n > 1:
+            if len(playing) == 1:
+                _count(self.solos, playing[0], change)
+            if len(playing) == width:
+                self.tutti += change
+
+            # The harmony before the newest is a gap if it's empty. The newest
+            # one is the end of the piece until there's another.
+            if not self._harmony_masks[-2]:
+                self.gaps += change
+
+    def _get_state(self, index):
+        """The musicians playing after event `index`, and their pitches."""
+        width = len(self.musicians_score_order)
+        row = index * width
+        state = {}
+        for i, musician in enumerate(self.musicians_score_order):
+            mask = self._pitch_masks[row + i]
+            if mask:
+                state[musician] = list(from_mask(mask))
+        return state
+
+    def get_streamed_event(self, index):
+        return StreamedEvent(index, self.score[index], self._get_state(index),
+                             from_mask(self._harmony_masks[index]))
+
+    def _get_view(self, name, make):
+        if name not in self._views:
+            self._views[name] = make()
+        return self._views[name]
 
-            # Was playing ==> Stop ==> Do nothing
-            # Wasn't playing ==> Not in event ==> Do nothing
-            # Wasn't playing ==> Stop ==> Do nothing (not possible)
+    @property
+    def reality(self):
+        return self._get_view('reality', lambda: [self._get_state(i) for i in range(self.n)])
 
-        return new_reality
+    @property
+    def harmonies(self):
+        return self._get_view('harmonies', lambda: [from_mask(mask) for mask in self._harmony_masks])
+
+    @property
+    def grid(self):
+        """What each musician was told to do at each event.
+
+        A list of pitches, or 'stop' at the event where they stopped.
+        """
+        def make():
+            grid = {name: [] for name in self.musicians_score_order}
+            for event, state in zip(self.score, self.reality):
+                for name in grid:
+                    if event.get(name) == 'stop':
+                        grid[name].append('stop')
+                    else:
+                        grid[name].append(state.get(name, []))
+            return grid
+        return self._get_view('grid', make)
 
     def get_harmony(self):
         pitches = []
@@ -130,163 +300,240 @@ class Grid(object):
             if len(playing) == 1:
                 self.solos[playing[0]] += 1
 
+    def get_statistics(self):
+        """The gaps, tutti, solos and density kept up to date by `add_event`."""
+        return self.gaps, self.tutti, _nonzero(self.solos), _nonzero(self.density)
+
+    def recount_statistics(self):
+        """Count what `get_statistics` gives again, over the whole piece.
+
+        A cross-check of `add_event` and `undo_event`, which leaves the
+        kept statistics as they were:
+
+        >>> from run import Runner
+        >>> from criteria import Criteria
+        >>> runner = Runner(criteria=Criteria({}), timeout=float('inf'))
+        >>> for seed in [1, 2, 3]:
+        ...     piece = runner.make_piece(seed=seed)
+        ...     score = list(piece.score)
+        ...     while piece.score:
+        ...         assert piece.get_statistics() == piece.recount_statistics()
+        ...         piece.undo_event()
+        ...     for event in score:
+        ...         piece.add_event(event)
+        ...         assert piece.get_statistics() == piece.recount_statistics()
+
+        """
+        kept = self.gaps, self.tutti, self.solos
+        self.count_gaps()
+        self.count_tutti()
+        self.count_solos()
+        density = Counter(len(state) for state in self.reality)
+        recounted = self.gaps, self.tutti, _nonzero(self.solos), _nonzero(density)
+        self.gaps, self.tutti, self.solos = kept
+        return recounted
+
     # Reporting, displaying
 
-    def report_density(self):
-        self.density = Counter()
-        for state in self.reality:
-            self.density[len(state)] += 1
+    def get_reports(self):
+        """Everything the reports show, made in one pass until the piece changes."""
+        return self._get_view('reports', lambda: Reports(self))
 
-        return self.density.most_common()
+    def report_density(self):
+        return self.get_reports().density.most_common()
 
     def notate_harmonies(self):
+        # Imports music21, which is slow, so only when it's needed
+        from notate_score import notate_score
+
         notate_score(
             self.musicians_score_order,
             self.instrument_names,
             self.grid
         )
 
-    def report_score(self):
-        for index, event in enumerate(self.score):
-            print index + 1
-            for name in [n for n in self.musicians_score_order if n in event]:
-                action = event[name]
-                if action != 'stop':
-                    action = spell(event[name])
-                # instrument = self.musicians[name]['instrument']
-                print '  {:>12} {}'.format(name, action)
-            print
-
-    def report_rhythm(self):
-        max_name_length = max([len(n) for n in self.musicians_score_order])
-        label_template = '{{:<{}}}  '.format(max_name_length)
-        lines = []
-        for name in self.musicians_score_order:
-            line = []
-            for event in self.grid[name]:
-                if event == [] or event == 'stop':
-                    line.append(' ')
-                else:
-                    line.append('-')
-
-            line = label_template.format(name) + ''.join(line)
-            lines.append(line)
-        return '\n'.join(lines)
-
-    def report_harmonies(self):
-        c = Counter()
-        lines = []
-        actual_length = len(self.grid[self.grid.keys()[0]])
-        for e in range(actual_length):
-            pitches = []
-            for name in self.musicians_score_order:
-                if self.grid[name][e] != 'stop':
-                    for p in self.grid[name][e]:
-                        if p not in pitches:
-                            pitches.append(p)
-            harmony = tuple(sorted(pitches))
-            c[harmony] += 1
-            line = []
-            for pc in range(12):
-                if pc in pitches:
-                    line.append('{:<3}'.format(pc))
-                else:
-                    line.append('   ')
-            lines.append(''.join(line))
-        for line in lines:
-            print line
-        print
-        print 'Number of different chords: ', len(c)
-        for k, n in c.most_common():
-            print n, k
-
-        print
-        chord_types_counter = self.count_chord_types(self.harmonies)
-        print 'Number of different chord types: ', len(chord_types_counter)
-        for chord_type, count in chord_types_counter.most_common():
-            print '{:<5} {}'.format(str(count), str(chord_type))
-
-        return lines
+    def report_score(self, f=None):
+        self.get_reports().write_score(f or sys.stdout)
+
+    def report_rhythm(self, f=None):
+        self.get_reports().write_rhythm(f or sys.stdout)
+
+    def report_harmonies(self, f=None):
+        self.get_reports().write_harmonies(f or sys.stdout)
 
     def count_chord_types(self, chords):
         chord_type_counter = Counter()
-        for chord in chords:
-            transpositions = get_all_transpositions(chord)
-            for t in transpositions:
-                if t in allowed_chord_types:
-                    chord_type_counter[t] += 1
-                    continue
+        for chord, n in Counter(chords).items():
+            for chord_type in get_chord_types(chord):
+                chord_type_counter[chord_type] += n
 
         return chord_type_counter
 
-    def report_reality(self):
-        print ''.join(['{:<12}'.format(name) for name in self.musicians_score_order])
-        for item in self.reality:
-            print ''.join(['{:<12}'.format(' '.join([str(pc) for pc in item.get(name, [])])) for name in self.musicians_score_order])
+    def report_reality(self, f=None):
+        self.get_reports().write_reality(f or sys.stdout)
 
-    def pngs(self):
+    def get_cells(self):
+        """Give the event number and music of each notation cell."""
         for event_index, event in enumerate(self.score):
-            if not any([True for n in event if event[n] != 'stop']):
-                continue
-
-            event_index += 1
-            music = []
-
-            for name in [n for n in self.musicians_score_order if n in event]:
-                action = event[name]
-                if action != 'stop':
-                    musician = {
-                        'instrument': self.musicians[name]['instrument'],
-                        'music': [
-                            {
-                                'pitches': action,
-                                'duration': 4.0
-                            }
-                        ],
-                    }
-                    music.append(musician)
-
-            write_notation_cell(music, self.path, event_index)
-
-    def reports(self):
-        print
-        self.report_score()
-        print
-        print self.report_rhythm()
-        print
-        self.report_harmonies()
-        print
-        self.report_reality()
-        print
-        print 'Density'
-        for d, c in self.report_density():
-            print d, c
+            music = self.get_cell(event)
+            if music:
+                yield event_index + 1, music
+
+    def get_cell(self, event):
+        """The music of the notation cell of an event, or None if it has none."""
+        if not any([True for n in event if event[n] != 'stop']):
+            return None
+
+        music = []
+        for name in [n for n in self.musicians_score_order if n in event]:
+            action = event[name]
+            if action != 'stop':
+                musician = {
+                    'instrument': self.musicians[name]['instrument'],
+                    'music': [
+                        {
+                            'pitches': action,
+                            'duration': 4.0
+                        }
+                    ],
+                }
+                music.append(musician)
+        return music
+
+    def pngs(self, musescore_path=None, workers=None, timeout=120, dpi=600, cache=None):
+        """Write the notation cells. Cells written before are linked instead.
+
+        Cells in this output directory's manifest or in the `RenderCache`
+        `cache` are linked. The MusicXML of every other cell is written
+        first, then all of them are rendered by `workers` MuseScore
+        processes at a time.
+
+        """
+        manifest = Manifest(os.path.dirname(self.path))
+        timings = []
+
+        start = time.time()
+        new_cells = []
+        n_linked = 0
+        for event_index, music in self.get_cells():
+            if manifest.link_cell(music, self.path, event_index):
+                n_linked += 1
+            elif cache and cache.get(cache.get_key(music, cache_settings, dpi),
+                                     os.path.join(self.path, str(event_index).zfill(2))):
+                n_linked += 1
+                manifest.add_cell(music, self.path, event_index)
+            else:
+                new_cells.append((event_index, music))
+        timings.append(('link', time.time() - start))
+
+        start = time.time()
+        musicxml_file_paths = [write_musicxml(music, self.path, event_index) for event_index, music in new_cells]
+        timings.append(('musicxml', time.time() - start))
+
+        start = time.time()
+        errors = render_pngs(musicxml_file_paths, dpi=dpi, musescore_path=musescore_path,
+                             timeout=timeout, workers=workers)
+        timings.append(('render', time.time() - start))
+
+        for (event_index, music), file_path in zip(new_cells, musicxml_file_paths):
+            if file_path not in errors:
+                manifest.add_cell(music, self.path, event_index)
+                if cache:
+                    cache.put(cache.get_key(music, cache_settings, dpi), file_path[:-len('.xml')])
+        manifest.save()
+        if cache:
+            cache.evict()
+
+        print 'Linked {} cells and rendered {}'.format(n_linked, len(new_cells) - len(errors))
+        for stage, seconds in timings:
+            print '  {:<10} {:.2f} s'.format(stage, seconds)
+        for file_path, error in sorted(errors.items()):
+            print '  {}'.format(error)
+        if cache:
+            print cache.report()
+
+        return timings
+
+    def reports(self, f=None):
+        self.get_reports().write_all(f or sys.stdout)
         return ''
 
-    def save(self):
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-        self.path = 'output/house_{}'.format(timestamp)
-        os.mkdir(self.path)
-        self.backup_path = os.path.join(self.path, 'backup.json')
+    def save(self, path=None):
+        """Save a backup of the piece to `path`, a new directory in output/ by default."""
+        self.path = path or get_new_path()
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        self.backup_path = os.path.join(self.path, backup.file_name)
 
         print 'SAVING TO {}'.format(self.backup_path)
 
-        d = {key: self.__dict__[key] for key in self.__dict__ if key not in self.dont_save}
-        for key in self.counters:
-            d[key] = list(d[key].elements())
-        json_string = json.dumps(d)
+        backup.write(self.path, self.to_dict())
 
-        with open(self.backup_path, 'w') as f:
-            f.write(json_string)
+        manifest = Manifest(os.path.dirname(self.path))
+        for path in manifest.add_piece(self.path, self.score):
+            print 'SAME SCORE AS {}'.format(path)
+        manifest.save()
 
     def load(self, path):
-        backup_path = os.path.join(path, 'backup.json')
-        with open(backup_path, 'r') as f:
-            json_string = f.read()
-        d = json.loads(json_string)
-
-        for key in d:
-            if key in self.counters:
-                self.__dict__[key] = Counter(d[key])
-            else:
-                self.__dict__[key] = d[key]
+        """Load a piece saved with `save`, or an old backup.json.
+
+        The piece is where it was loaded from, ready for `pngs`, whatever
+        path it was saved with.
+
+        >>> import tempfile
+        >>> old = Grid()
+        >>> old.load('output/house_20160124203731')
+        >>> path = tempfile.mkdtemp()
+        >>> backup_path = backup.write(path, old.to_dict())
+        >>> grid = Grid()
+        >>> grid.load(path)
+        >>> grid.path == path, grid.backup_path == os.path.join(path, backup.file_name)
+        (True, True)
+        >>> grid.score == old.score
+        True
+
+        """
+        if os.path.exists(os.path.join(path, backup.file_name)):
+            self.from_dict(backup.read(path))
+        else:
+            backup_path = os.path.join(path, backup.json_file_name)
+            with open(backup_path, 'r') as f:
+                json_string = f.read()
+            d = json.loads(json_string)
+
+            for key in self.counters:
+                if key in d:
+                    d[key] = Counter(d[key])
+            self.from_dict(d)
+
+        self.path = path
+        self.backup_path = backup.get_backup_path(path)
+
+    def to_dict(self):
+        """Give the state of the piece, leaving out what can't be copied."""
+        d = {key: self.__dict__[key] for key in self.__dict__ if key not in self.dont_save}
+        for key in self.views:
+            d[key] = getattr(self, key)
+        return d
+
+    def from_dict(self, d):
+        """Restore the state of the piece from `to_dict` output.
+
+        Everything that follows from the score is remade by adding its
+        events again.
+
+        """
+        d = dict(d)
+        score = d.pop('score')
+        for key in self.views + self.counters:
+            d.pop(key, None)
+
+        # Some old backups saved these class attributes too
+        for key in ['dont_save', 'counters']:
+            d.pop(key, None)
+        self.__dict__.update(d)
+        self.instrument_names = [self.musicians[name]['instrument'] for name in self.musicians_score_order]
+
+        self._reset()
+        for event in score:
+            self.add_event(event)
@@ -1,10 +1,73 @@
+# Pitch-class sets as 12-bit integer masks: bit `p` is set when pitch class
+# `p` is in the set. There are only 4096 of them, so everything we need to
+# know about a set is precomputed into tables indexed by mask.
+N_MASKS = 1 << 12
+FULL_MASK = N_MASKS - 1
+
+
+def to_mask(chord):
+    """Give the 12-bit pitch-class-set mask of `chord`.
+
+    >>> to_mask((0, 4, 7))
+    145
+
+    """
+    mask = 0
+    for p in chord:
+        mask |= 1 << (p % 12)
+    return mask
+
+
+def transpose_mask(mask, interval):
+    """Rotate a pitch-class-set mask up by `interval` semitones."""
+    interval %= 12
+    return ((mask << interval) | (mask >> (12 - interval))) & FULL_MASK
+
+
+# mask -> sorted tuple of pitch classes
+_pitches = [tuple(p for p in range(12) if mask >> p & 1) for mask in range(N_MASKS)]
+
+
+def from_mask(mask):
+    """Give the sorted pitch classes in `mask`.
+
+    >>> from_mask(145)
+    (0, 4, 7)
+
+    """
+    return _pitches[mask]
+
+
+def _get_transposition_masks(mask):
+    """Masks of the set transposed so that each of its members is 0."""
+    return tuple(sorted(set([transpose_mask(mask, -p) for p in _pitches[mask]])))
+
+
+# mask -> masks of every transposition of the set with one of its members on 0
+_transpositions = [_get_transposition_masks(mask) for mask in range(N_MASKS)]
+
+# mask -> the transposition with the lowest mask, a canonical name for the set
+# and all of its transpositions
+_normal_form = [min(t) if t else 0 for t in _transpositions]
+
+
 def zero(root, chord):
     """Give the pitch classes of `chord` as if `root` was 0."""
-    return tuple(sorted([(p - root) % 12 for p in chord]))
+    return _pitches[transpose_mask(to_mask(chord), -root)]
+
+
+def normal_form(chord):
+    """Give the same tuple for `chord` and every transposition of it.
+
+    >>> normal_form((2, 7, 11)) == normal_form((0, 4, 7))
+    True
+
+    """
+    return _pitches[_normal_form[to_mask(chord)]]
 
 
 def get_all_transpositions(chord):
-    return list(set([zero(p, chord) for p in chord]))
+    return [_pitches[t] for t in _transpositions[to_mask(chord)]]
 
 
 allowed_chord_types = [
@@ -231,11 +294,38 @@ for c in allowed_chord_types:
     allowed_chord_types_transpositions.extend(get_all_transpositions(c))
 allowed_chord_types_transpositions.append(())
 
+allowed_chord_type_masks = [to_mask(c) for c in allowed_chord_types]
+
+
+def _get_chord_types(mask):
+    transpositions = _transpositions[mask]
+    return tuple(c for c, c_mask in zip(allowed_chord_types, allowed_chord_type_masks)
+                 if c_mask in transpositions)
+
+
+# mask -> the allowed chord types the set is a transposition of
+_chord_types = [_get_chord_types(mask) for mask in range(N_MASKS)]
+
+# mask -> whether the set is allowed. The empty set (silence) is allowed.
+_allowed = [mask == 0 or bool(_chord_types[mask]) for mask in range(N_MASKS)]
+
+
+def is_allowed_mask(mask):
+    return _allowed[mask]
+
 
 def is_allowed(chord):
-    if not chord:
-        return True
-    return zero(chord[0], chord) in allowed_chord_types_transpositions
+    return _allowed[to_mask(chord)]
+
+
+def get_chord_types(chord):
+    """Give the allowed chord types that `chord` is a transposition of.
+
+    >>> get_chord_types((2, 7, 11))
+    ((0, 4, 7),)
+
+    """
+    return _chord_types[to_mask(chord)]
 
 
 def find_supersets(subset, chord_type):
@@ -251,8 +341,66 @@ def find_supersets(subset, chord_type):
     return supersets
 
 
-def find_all_supersets(subset):
+def _find_all_supersets(subset):
     supersets = []
     for chord_type in allowed_chord_types:
         supersets.extend(find_supersets(subset, chord_type))
     return supersets
+
+
+def _submasks(mask):
+    """Give every subset of `mask`, including `mask` and the empty set."""
+    sub = mask
+    while True:
+        yield sub
+        if not sub:
+            return
+        sub = (sub - 1) & mask
+
+
+def _build_superset_index():
+    """Map every mask to the supersets `_find_all_supersets` gives for it.
+
+    `find_supersets` finds every superset of a chord type with the first
+    offset (the lowest pitch of the subset), so for each chord type the
+    order is the order of the rotations that reach them from that offset.
+    Walking chord types, then rotations, then the lowest pitch, and handing
+    each transposition to the subsets it contains whose lowest pitch is that
+    offset gives exactly the same lists in the same order.
+
+    """
+    index = [[] for _ in range(N_MASKS)]
+    for chord_type, chord_type_mask in zip(allowed_chord_types, allowed_chord_type_masks):
+        seen = set()
+        for root in chord_type:
+            for offset in range(12):
+                transposition = transpose_mask(chord_type_mask, offset - root)
+                offset_bit = 1 << offset
+                above_offset = transposition & ~((offset_bit << 1) - 1)
+                for sub in _submasks(above_offset):
+                    subset = sub | offset_bit
+                    if (subset, transposition) not in seen:
+                        seen.add((subset, transposition))
+                        index[subset].append(_pitches[transposition])
+    return [tuple(supersets) for supersets in index]
+
+
+# mask -> allowed chords containing it, in `_find_all_supersets` order
+_supersets = _build_superset_index()
+
+
+def find_all_supersets(subset):
+    """Give every transposition of every allowed chord type containing `subset`.
+
+    The order matters: callers weight the options by their position.
+
+    >>> find_all_supersets([0, 4])[:3]
+    [(0, 4, 7), (0, 4, 9), (0, 4, 7, 10)]
+
+    """
+    mask = to_mask(subset)
+    if list(_pitches[mask]) != list(subset):
+        # The order depends on the order of `subset`, which is only indexed
+        # when it's sorted and has no duplicates
+        return _find_all_supersets(subset)
+    return list(_supersets[mask])
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""An SQLite index of the statistics of the pieces in output/.
+
+    ./index.py update
+    ./index.py query 'density[6] >= 3' 'solos[Trevor] >= 1'
+
+`update` only loads pieces that are new or whose backup changed since the
+last update, and forgets pieces whose directories are gone.
+
+A query is conditions that all have to be true, given as separate
+arguments or joined with 'and'. A condition compares a statistic to a
+number. The statistics are:
+
+    n_events, gaps, tutti
+    solos[<musician>]           states where only they are playing
+    density[<n>]                states with n musicians playing
+    chord_types[<chord type>]   like chord_types[0,4,7]
+    pitch_classes[<pc>]         harmonies with the pitch class in them
+
+"""
+
+import os
+import re
+import sqlite3
+from argparse import ArgumentParser
+
+import backup
+
+
+default_db_path = os.path.join('output', 'index.sqlite')
+
+schema = """
+CREATE TABLE IF NOT EXISTS pieces (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    n_events INTEGER,
+    gaps INTEGER,
+    tutti INTEGER,
+    seed INTEGER
+);
+CREATE TABLE IF NOT EXISTS solos (path TEXT, key TEXT, n INTEGER);
+CREATE TABLE IF NOT EXISTS density (path TEXT, key INTEGER, n INTEGER);
+CREATE TABLE IF NOT EXISTS chord_types (path TEXT, key TEXT, n INTEGER);
+CREATE TABLE IF NOT EXISTS pitch_classes (path TEXT, key INTEGER, n INTEGER);
+CREATE INDEX IF NOT EXISTS solos_key ON solos (key, n);
+CREATE INDEX IF NOT EXISTS density_key ON density (key, n);
+CREATE INDEX IF NOT EXISTS chord_types_key ON chord_types (key, n);
+CREATE INDEX IF NOT EXISTS pitch_classes_key ON pitch_classes (key, n);
+"""
+
+columns = ['n_events', 'gaps', 'tutti']
+
+# The statistics counted by a key, and how to read the key in a query
+counted = {
+    'solos': str,
+    'density': int,
+    'chord_types': lambda key: chord_type_key([int(pc) for pc in key.split(',')]),
+    'pitch_classes': int,
+}
+
+condition_pattern = re.compile(r'^\s*(\w+)\s*(?:\[([^\]]+)\])?\s*(>=|<=|==|!=|=|>|<)\s*(-?\d+)\s*$')
+
+
+class QueryError(Exception):
+    pass
+
+
+def chord_type_key(chord_type):
+    return ','.join(str(pc) for pc in chord_type)
+
+
+def connect(db_path=default_db_path):
+    db = sqlite3.connect(db_path)
+    db.executescript(schema)
+    return db
+
+
+def get_stats(path):
+    from grid import Grid
+
+    grid = Grid()
+    grid.load(path)
+
+    stats = {
+        'n_events': len(grid.score),
+        'gaps': grid.gaps,
+        'tutti': grid.tutti,
+        'seed': grid.__dict__.get('seed'),
+        'solos': grid.solos,
+        'density': grid.density,
+        'chord_types': {chord_type_key(chord_type): n
+                        for chord_type, n in grid.count_chord_types(grid.harmonies).items()},
+        'pitch_classes': grid.pc_counter,
+    }
+    return stats
+
+
+def forget(db, path):
+    db.execute('DELETE FROM pieces WHERE path = ?', (path,))
+    for table in counted:
+        db.execute('DELETE FROM {} WHERE path = ?'.format(table), (path,))
+
+
+def add(db, path, mtime, stats):
+    db.execute(
+        'INSERT INTO pieces (path, mtime, n_events, gaps, tutti, seed) VALUES (?, ?, ?, ?, ?, ?)',
+        (path, mtime, stats['n_events'], stats['gaps'], stats['tutti'], stats['seed'])
+    )
+    for table in counted:
+        db.executemany(
+            'INSERT INTO {} (path, key, n) VALUES (?, ?, ?)'.format(table),
+            [(path, key, n) for key, n in stats[table].items()]
+        )
+
+
+def update(db, output_path='output'):
+    indexed = dict(db.execute('SELECT path, mtime FROM pieces'))
+
+    paths = backup.get_piece_paths(output_path)
+    added = 0
+    for path in paths:
+        backup_path = backup.get_backup_path(path)
+        if not backup_path:
+            continue
+        mtime = os.path.getmtime(backup_path)
+        if indexed.get(path) == mtime:
+            continue
+
+        stats = get_stats(path)
+        forget(db, path)
+        add(db, path, mtime, stats)
+        added += 1
+
+    gone = set(indexed) - set(paths)
+    for path in gone:
+        forget(db, path)
+
+    db.commit()
+    print 'Indexed {} pieces, forgot {}'.format(added, len(gone))
+
+
+def parse_condition(condition):
+    """Give SQL for a condition and its parameters.
+
+    >>> parse_condition('density[6] >= 3')
+    ('COALESCE((SELECT n FROM density WHERE path = pieces.path AND key = ?), 0) >= ?', [6, 3])
+    >>> parse_condition('gaps = 0')
+    ('gaps = ?', [0])
+
+    """
+    match = condition_pattern.match(condition)
+    if not match:
+        raise QueryError('Could not read condition: {}'.format(condition))
+    name, key, operator, value = match.groups()
+    if operator == '==':
+        operator = '='
+
+    if name in columns:
+        if key is not None:
+            raise QueryError('{} has no [key]'.format(name))
+        return '{} {} ?'.format(name, operator), [int(value)]
+
+    if name in counted:
+        if key is None:
+            raise QueryError('{} needs a [key]'.format(name))
+        try:
+            key = counted[name](key.strip())
+        except ValueError:
+            raise QueryError('Bad key for {}: {}'.format(name, key))
+        sql = 'COALESCE((SELECT n FROM {} WHERE path = pieces.path AND key = ?), 0) {} ?'.format(name, operator)
+        return sql, [key, int(value)]
+
+    raise QueryError('Unknown statistic: {}'.format(name))
+
+
+def query(db, conditions):
+    """Give the rows of `pieces` that meet every condition."""
+    where = []
+    parameters = []
+    for condition in conditions:
+        for part in re.split(r'\s+and\s+', condition.strip()):
+            sql, params = parse_condition(part)
+            where.append(sql)
+            parameters.extend(params)
+
+    sql = 'SELECT path, n_events, gaps, tutti FROM pieces'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY path'
+    return db.execute(sql, parameters).fetchall()
+
+
+def cli():
+    parser = ArgumentParser(description='Index and search the pieces in output/')
+    parser.add_argument('command', choices=['update', 'query'])
+    parser.add_argument('conditions', nargs='*',
+        help='Conditions for query, like "density[6] >= 3" or "solos[Trevor] >= 1".')
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with the house_* pieces.')
+    parser.add_argument('--db', '-d',
+        help='The index database. Defaults to index.sqlite in the output directory.')
+    parser.add_argument('--update', '-u', action='store_true',
+        help='Update the index before querying.')
+    args = parser.parse_args()
+
+    db = connect(args.db or os.path.join(args.output, 'index.sqlite'))
+
+    if args.command == 'update' or args.update:
+        update(db, args.output)
+
+    if args.command == 'query':
+        try:
+            rows = query(db, args.conditions)
+        except QueryError as e:
+            parser.error(str(e))
+
+        print '{:<40} {:>8} {:>5} {:>6}'.format('path', 'events', 'gaps', 'tutti')
+        for row in rows:
+            print '{:<40} {:>8} {:>5} {:>6}'.format(*row)
+        print '{} pieces'.format(len(rows))
+
+
+if __name__ == '__main__':
+    cli()
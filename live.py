@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""Make a piece during a performance, one event at each cue.
+
+Between cues, `LivePerformance.prepare` makes the next few events ahead
+of time. At a cue, `next_event` gives the next of them. If there are
+none ready, it makes one within the latency budget, and if that fails
+too it gives a safe event that's always allowed after the current
+state: someone stops or starts playing one pitch.
+
+Only events that haven't been given yet are undone at a dead end. The
+latency of every cue is recorded and written as JSON when the performance
+ends:
+
+    ./live.py                       press Enter to cue each event
+    ./live.py --simulate -e 1000    cue as fast as possible
+
+"""
+
+import sys
+import json
+import bisect
+from collections import Counter
+from argparse import ArgumentParser
+
+from clock import monotonic
+from feb3 import Piece
+from run import Runner
+from harmony_utils import is_allowed
+from failures import GenerationFailure
+from pipeline import ScoreReporter
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+buckets = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+
+
+def get_harmony_after(piece, event):
+    """The harmony after `event`, if it was added to the piece."""
+    pitches = set()
+    for name, pitches_played in piece.previous_state.items():
+        if name not in event:
+            pitches.update(pitches_played)
+    for action in event.values():
+        if action != 'stop':
+            pitches.update(action)
+    return tuple(sorted(pitches))
+
+
+def get_safe_event(piece):
+    """An event that can follow the piece's last state, without retries.
+
+    Someone playing stops, or everyone stops, or someone who isn't playing
+    starts on one pitch. The harmony left has to be allowed and different
+    from the last one.
+
+    """
+    state = piece.previous_state
+    playing = [name for name in piece.musicians_score_order if state.get(name)]
+    resting = [name for name in piece.musicians_score_order if not state.get(name)]
+
+    candidates = [{name: 'stop'} for name in playing]
+    if playing:
+        candidates.append({name: 'stop' for name in playing})
+    for name in resting:
+        candidates.extend({name: [pc]} for pc in range(12))
+
+    for event in candidates:
+        harmony = get_harmony_after(piece, event)
+        if is_allowed(harmony) and harmony != piece.previous_harmony:
+            return event
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * p / 100.0), len(sorted_values) - 1)]
+
+
+class LivePerformance(object):
+    def __init__(self, runner, n_events=40, quentin=False, budget=0.005, buffer_size=3, stages=None, seed=None):
+        self.runner = runner
+        runner.exception_counter = Counter()
+        runner.backtrack_counter = Counter()
+        self.piece = Piece(runner, n_events=n_events, quentin=quentin, seed=seed)
+
+        # Seconds to give an event in at a cue
+        self.budget = budget
+        self.buffer_size = buffer_size
+
+        # Given every event as it's performed, like a display
+        self.stages = stages or []
+        for stage in self.stages:
+            stage.start(self.piece)
+
+        self.n_given = 0
+        self.safe_event = None
+        self.latencies = []
+        self.sources = Counter()
+
+    @property
+    def n_buffered(self):
+        return len(self.piece.score) - self.n_given
+
+    @property
+    def done(self):
+        return self.piece.done and not self.n_buffered
+
+    def _make_event(self, deadline):
+        """Add the next event to the piece. None at the end of the piece."""
+        self.runner.deadline = deadline
+        try:
+            event = self.runner.try_f(self.piece.make_event)
+        except GenerationFailure:
+            return False
+        if not event:
+            return None
+        self.piece.add_event(event)
+        return True
+
+    def prepare(self, seconds=1.0):
+        """Make events ahead, for up to `seconds`. Call this between cues."""
+        deadline = monotonic() + seconds
+        while self.n_buffered < self.buffer_size and not self.piece.done and monotonic() < deadline:
+            if self._make_event(deadline) is False:
+                if not self.n_buffered:
+                    break
+                # A dead end. Undo an event that hasn't been given yet.
+                self.piece.undo_event()
+
+        if not self.n_buffered and not self.piece.done:
+            self.safe_event = get_safe_event(self.piece)
+
+    def next_event(self):
+        """Give the next event as a `StreamedEvent`, or None at the end of the piece."""
+        start = monotonic()
+        if self.n_buffered:
+            source = 'buffer'
+        else:
+            made = self._make_event(start + self.budget)
+            if made:
+                source = 'made'
+            elif made is None:
+                return None
+            else:
+                self.piece.add_event(self.safe_event or get_safe_event(self.piece))
+                source = 'safe'
+
+        streamed_event = self.piece.get_streamed_event(self.n_given)
+        self.n_given += 1
+        self.safe_event = None
+
+        self.latencies.append(monotonic() - start)
+        self.sources[source] += 1
+
+        for stage in self.stages:
+            stage.add(self.piece, streamed_event)
+        return streamed_event
+
+    def finish(self):
+        for stage in self.stages:
+            stage.finish(self.piece)
+
+    def get_latency_report(self):
+        latencies = sorted(latency * 1000 for latency in self.latencies)
+        histogram = Counter(bisect.bisect_left(buckets, latency) for latency in latencies)
+        return {
+            'budget_ms': self.budget * 1000,
+            'n_events': len(latencies),
+            'sources': dict(self.sources),
+            'over_budget': sum(1 for latency in latencies if latency > self.budget * 1000),
+            'percentiles_ms': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'histogram_ms': [[str(buckets[i]), histogram[i]] for i in range(len(buckets))],
+        }
+
+
+def cli():
+    parser = ArgumentParser(description='Make a piece one event at each cue')
+    parser.add_argument('--events', '-e', default=40, type=int,
+        help='The number of events to make.')
+    parser.add_argument('--quentin', '-q', action='store_true',
+        help='Use Quentin band instrumentation rather than the default Sonic Lib ensemble')
+    parser.add_argument('--budget-ms', default=5.0, type=float,
+        help='The most milliseconds to spend making an event at a cue before giving a safe one.')
+    parser.add_argument('--buffer', default=3, type=int,
+        help='The number of events to make ahead of the cues.')
+    parser.add_argument('--prepare-seconds', default=1.0, type=float,
+        help='The most seconds to spend making events ahead after each cue. 0 makes every event at its cue.')
+    parser.add_argument('--seed', type=int,
+        help='Seed the piece with this, to make the same piece again.')
+    parser.add_argument('--simulate', action='store_true',
+        help='Cue each event as soon as the last one is prepared, without waiting for Enter.')
+    parser.add_argument('--latency-out', default='latency.json',
+        help='Where to write the latency histogram.')
+    args = parser.parse_args()
+
+    stages = [] if args.simulate else [ScoreReporter()]
+    performance = LivePerformance(Runner(), n_events=args.events, quentin=args.quentin,
+                                  budget=args.budget_ms / 1000.0, buffer_size=args.buffer, stages=stages,
+                                  seed=args.seed)
+
+    if not args.simulate:
+        print 'Press Enter to cue the next event, or q and Enter to stop.'
+
+    performance.prepare(args.prepare_seconds)
+    while not performance.done:
+        if not args.simulate and sys.stdin.readline().strip() == 'q':
+            break
+        if not performance.next_event():
+            break
+        if args.prepare_seconds:
+            performance.prepare(args.prepare_seconds)
+    performance.finish()
+
+    report = performance.get_latency_report()
+    with open(args.latency_out, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print '{} events: {}'.format(report['n_events'], ', '.join(
+        '{} {}'.format(n, source) for source, n in sorted(report['sources'].items())))
+    print 'Latency (ms): {}'.format(', '.join(
+        '{} {:.3f}'.format(name, report['percentiles_ms'][name]) for name in ['p50', 'p90', 'p99', 'max']
+        if report['percentiles_ms'][name] is not None))
+    print '{} over the {} ms budget. Wrote {}'.format(report['over_budget'], report['budget_ms'], args.latency_out)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,60 @@
+"""Logging for making pieces, with repeated messages rate limited.
+
+Messages logged from the generation loop can come thousands of times a
+second. `RateLimit` lets each message through at most `per_second` times
+a second, and tells how many were dropped with the next one let through.
+
+"""
+
+import logging
+
+from clock import monotonic
+
+
+levels = ['debug', 'info', 'warning', 'error']
+
+
+class RateLimit(logging.Filter):
+    def __init__(self, per_second=5):
+        logging.Filter.__init__(self)
+        self.per_second = per_second
+
+        # (logger name, formatted message) to (start of the second, let through, dropped)
+        self.windows = {}
+
+    def filter(self, record):
+        # The formatted message, so the same format with other arguments
+        # isn't dropped with it
+        message = record.getMessage()
+        key = (record.name, message)
+        now = monotonic()
+        start, n, dropped = self.windows.get(key, (now, 0, 0))
+        if now - start >= 1:
+            start, n = now, 0
+
+        if n >= self.per_second:
+            self.windows[key] = (start, n, dropped + 1)
+            return False
+
+        if dropped:
+            record.msg = '{} ({} more like this dropped)'.format(message, dropped)
+            record.args = ()
+        self.windows[key] = (start, n + 1, 0)
+        return True
+
+
+def configure(level='warning', per_second=5):
+    """Log to stderr at `level` and above."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(RateLimit(per_second))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+
+# Until `configure` is called, say nothing, not even that there's nowhere to log to
+logging.getLogger().addHandler(logging.NullHandler())
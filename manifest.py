@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""Content hashes of pieces and notation cells, to notice duplicates.
+
+The manifest is output/manifest.json. It maps the hash of each score to
+the pieces with that score, and the hash of each notation cell (its
+instruments and pitches) to the first files written for it. `Grid.save`
+flags a piece whose score was already made, and `Grid.pngs` links a cell
+that was already written instead of writing it again.
+
+Cells are hard linked, so a cell takes space on the disk once however
+many pieces have it. To hash the pieces already in output/ and link their
+duplicate cells:
+
+    ./manifest.py update --link
+
+"""
+
+import os
+import json
+import glob
+import shutil
+import hashlib
+from argparse import ArgumentParser
+
+import backup
+
+
+file_name = 'manifest.json'
+
+
+def _hash(thing):
+    return hashlib.sha1(json.dumps(thing, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def score_hash(score):
+    """Hash a score, whatever order the pitches of each action are in.
+
+    >>> score_hash([{'Andrea': [4, 0]}, {'Andrea': 'stop'}]) == score_hash([{'Andrea': [0, 4]}, {'Andrea': 'stop'}])
+    True
+
+    """
+    events = []
+    for event in score:
+        events.append({name: action if action == 'stop' else sorted(action)
+                       for name, action in event.items()})
+    return _hash(events)
+
+
+def cell_hash(music):
+    """Hash a cell, as passed to `write_notation_cell`."""
+    return _hash(music)
+
+
+def get_cell_base(path, event_index):
+    return os.path.join(path, str(event_index).zfill(2))
+
+
+def get_cell_files(path, event_index):
+    return get_files(get_cell_base(path, event_index))
+
+
+def get_files(base):
+    """The MusicXML and the PNG pages MuseScore wrote for a cell."""
+    return sorted(glob.glob(base + '.xml') + glob.glob(base + '-[0-9]*.png'))
+
+
+def link(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Across file systems, or where there are no hard links
+        shutil.copyfile(source, destination)
+
+
+class Manifest(object):
+    def __init__(self, output_path='output'):
+        self.path = os.path.join(output_path, file_name)
+        self.pieces = {}
+        self.cells = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                d = json.load(f)
+            self.pieces = d['pieces']
+            self.cells = d['cells']
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'pieces': self.pieces, 'cells': self.cells}, f, indent=1, sort_keys=True)
+
+    def add_piece(self, path, score):
+        """Remember a piece and give the other pieces with the same score."""
+        paths = self.pieces.setdefault(score_hash(score), [])
+        if path not in paths:
+            paths.append(path)
+        return [p for p in paths if p != path]
+
+    def add_cell(self, music, path, event_index):
+        """Remember the files of a cell, if no others are remembered for it."""
+        h = cell_hash(music)
+        if not self.find_cell(h):
+            self.cells[h] = get_cell_base(path, event_index)
+
+    def find_cell(self, h):
+        """Give the base path of a cell's files, if they're still there."""
+        base = self.cells.get(h)
+        if base and glob.glob(base + '.xml'):
+            return base
+
+    def link_cell(self, music, path, event_index):
+        """Link the files of a cell written before. False if there aren't any."""
+        source_base = self.find_cell(cell_hash(music))
+        destination_base = get_cell_base(path, event_index)
+        if not source_base or source_base == destination_base:
+            return False
+
+        for source in get_files(source_base):
+            destination = destination_base + source[len(source_base):]
+            if not (os.path.exists(destination) and os.path.samefile(source, destination)):
+                link(source, destination)
+        return True
+
+
+def update(output_path='output', link_cells=False):
+    """Hash every piece and cell in output/. Optionally link duplicate cells."""
+    from grid import Grid
+
+    manifest = Manifest(output_path)
+    n_linked = 0
+    saved = 0
+    for path in backup.get_piece_paths(output_path):
+        if not backup.get_backup_path(path):
+            continue
+
+        grid = Grid()
+        grid.load(path)
+        manifest.add_piece(path, grid.score)
+
+        for event_index, music in grid.get_cells():
+            if not get_cell_files(path, event_index):
+                continue
+            if link_cells:
+                # Files with no other links are freed when they're replaced
+                freed = sum(os.path.getsize(f) for f in get_cell_files(path, event_index)
+                            if os.stat(f).st_nlink == 1)
+                if manifest.link_cell(music, path, event_index):
+                    n_linked += 1
+                    saved += freed
+                    continue
+            manifest.add_cell(music, path, event_index)
+
+    manifest.save()
+
+    print '{} pieces, {} different scores, {} different cells'.format(
+        sum(len(paths) for paths in manifest.pieces.values()), len(manifest.pieces), len(manifest.cells))
+    for paths in manifest.pieces.values():
+        if len(paths) > 1:
+            print 'Same score: {}'.format(' '.join(paths))
+    if link_cells:
+        print 'Linked {} cells, freeing {:.1f} MB'.format(n_linked, saved / 1e6)
+
+
+def cli():
+    parser = ArgumentParser(description='Find duplicate pieces and notation cells in output/')
+    parser.add_argument('command', choices=['update'])
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with the house_* pieces.')
+    parser.add_argument('--link', action='store_true',
+        help='Replace the files of cells written before with links to the first ones.')
+    args = parser.parse_args()
+
+    update(args.output, link_cells=args.link)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+"""Write notation cells as MusicXML directly, without music21.
+
+A cell is always one measure of 4/4, each instrument playing its notes
+one after another, so it can be written from templates. The instruments
+and their names are the ones music21 gives for the names in the
+ensembles, with proper clefs, and Clarinet and Guitar written
+transposed. Pitches are spelled the way music21 spells MIDI numbers.
+
+`write_notation_cell.write_musicxml` uses this for every cell it can.
+To compare it with music21, where music21 is installed, or with the cells
+music21 wrote for the pieces in output/:
+
+    ./musicxml.py validate
+    ./musicxml.py validate --saved
+    ./musicxml.py benchmark
+
+"""
+
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ElementTree
+
+
+# Part of the key of a rendered cell in a `RenderCache`
+writer = 'musicxml 1'
+
+divisions = 10080
+
+# Step and alter of each pitch class
+spellings = [
+    ('C', 0), ('C', 1), ('D', 0), ('E', -1), ('E', 0), ('F', 0),
+    ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('B', -1), ('B', 0),
+]
+accidentals = {-1: 'flat', 0: 'natural', 1: 'sharp'}
+steps = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+# Durations in quarter notes
+note_types = {
+    4.0: ('whole', 0),
+    3.0: ('half', 1),
+    2.0: ('half', 0),
+    1.5: ('quarter', 1),
+    1.0: ('quarter', 0),
+    0.75: ('eighth', 1),
+    0.5: ('eighth', 0),
+    0.25: ('16th', 0),
+}
+
+treble = ('G', 2, 0)
+bass = ('F', 4, 0)
+treble_8vb = ('G', 2, -1)
+
+instruments = {
+    # name: (instrument name, part name, abbreviation, MIDI program, clef,
+    #        MusicXML <transpose>: (diatonic, chromatic, octave-change) from
+    #        written to sounding pitch)
+    'Flute': ('Flute', 'Flute', 'Fl', 74, treble, None),
+    'Voice': ('Voice', 'Voice', 'V', 53, treble, None),
+    'Oboe': ('Oboe', 'Oboe', 'Ob', 69, treble, None),
+    'Cello': ('Violoncello', 'Cello', 'Vc', 43, bass, None),
+    'Piano': ('Piano', 'Piano', 'Pno', 1, treble, None),
+    'Clarinet': ('Clarinet', 'Clarinet', 'Cl', 72, treble, (-1, -2, 0)),
+    'Organ': ('Organ', 'Organ', 'Org', 20, treble, None),
+    'Percussion': ('Percussion', 'Percussion', 'Perc', None, treble, None),
+    'Guitar': ('Guitar', 'Guitar', 'Gtr', 25, treble_8vb, (0, 0, -1)),
+}
+
+header = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE score-partwise
+  PUBLIC '-//Recordare//DTD MusicXML 2.0 Partwise//EN'
+  'http://www.musicxml.org/dtds/partwise.dtd'>
+<score-partwise>
+  <movement-title></movement-title>
+  <identification>
+    <creator type="composer"></creator>
+  </identification>
+  <defaults>
+    <scaling>
+      <millimeters>{millimeters}</millimeters>
+      <tenths>{tenths}</tenths>
+    </scaling>
+  </defaults>
+  <part-list>
+{score_parts}
+  </part-list>
+{parts}
+</score-partwise>
+'''
+
+score_part_template = '''    <score-part id="P{number}">
+      <part-name>{part_name}</part-name>
+      <part-abbreviation>{abbreviation}</part-abbreviation>
+      <score-instrument id="P{number}-I1">
+        <instrument-name>{instrument_name}</instrument-name>
+        <instrument-abbreviation>{abbreviation}</instrument-abbreviation>
+      </score-instrument>
+      <midi-instrument id="P{number}-I1">
+        <midi-channel>{channel}</midi-channel>{program}
+      </midi-instrument>
+    </score-part>'''
+
+part_template = '''  <part id="P{number}">
+    <measure number="1">
+      <attributes>
+        <divisions>{divisions}</divisions>
+        <time>
+          <beats>4</beats>
+          <beat-type>4</beat-type>
+        </time>
+        <clef>
+          <sign>{sign}</sign>
+          <line>{line}</line>{octave_change}
+        </clef>{transpose}
+      </attributes>
+{notes}
+      <barline location="right">
+        <bar-style>light-heavy</bar-style>
+      </barline>
+    </measure>
+  </part>'''
+
+transpose_template = '''
+        <transpose>
+          <diatonic>{diatonic}</diatonic>
+          <chromatic>{chromatic}</chromatic>
+          <octave-change>{octave}</octave-change>
+        </transpose>'''
+
+note_template = '''      <note>{chord}
+        <pitch>
+          <step>{step}</step>
+          <alter>{alter}</alter>
+          <octave>{octave}</octave>
+        </pitch>
+        <duration>{duration}</duration>
+        <type>{type}</type>{dots}
+        <accidental>{accidental}</accidental>
+      </note>'''
+
+
+def can_write(music):
+    """Whether a cell fits what this writer knows: one measure of known instruments."""
+    for musician in music:
+        if musician['instrument'] not in instruments:
+            return False
+        if any(event['duration'] not in note_types or not event['pitches'] for event in musician['music']):
+            return False
+        if sum(event['duration'] for event in musician['music']) > 4.0:
+            return False
+    return True
+
+
+def spell(midi):
+    """Give the step, alter and octave of a MIDI note number.
+
+    >>> spell(60), spell(63), spell(70)
+    (('C', 0, 4), ('E', -1, 4), ('B', -1, 4))
+
+    """
+    step, alter = spellings[midi % 12]
+    return step, alter, midi // 12 - 1
+
+
+def write_note(midi, duration, chord):
+    step, alter, octave = spell(midi)
+    note_type, dots = note_types[duration]
+    return note_template.format(
+        chord='\n        <chord/>' if chord else '',
+        step=step,
+        alter=alter,
+        octave=octave,
+        duration=int(duration * divisions),
+        type=note_type,
+        dots='\n        <dot/>' * dots,
+        accidental=accidentals[alter],
+    )
+
+
+def write_part(number, musician):
+    _, _, _, _, (sign, line, octave_change), transposition = instruments[musician['instrument']]
+
+    transpose = ''
+    written = 0
+    if transposition:
+        diatonic, chromatic, octave = transposition
+        written = -(chromatic + 12 * octave)
+        transpose = transpose_template.format(diatonic=diatonic, chromatic=chromatic, octave=octave)
+
+    notes = []
+    for event in musician['music']:
+        for i, pc in enumerate(sorted(event['pitches'])):
+            notes.append(write_note(pc + 60 + written, event['duration'], chord=i > 0))
+
+    return part_template.format(
+        number=number,
+        divisions=divisions,
+        transpose=transpose,
+        sign=sign,
+        line=line,
+        octave_change='\n          <clef-octave-change>{}</clef-octave-change>'.format(octave_change) if octave_change else '',
+        notes='\n'.join(notes),
+    )
+
+
+def write_score_part(number, musician):
+    instrument_name, part_name, abbreviation, program, _, _ = instruments[musician['instrument']]
+    return score_part_template.format(
+        number=number,
+        part_name=escape(part_name),
+        abbreviation=escape(abbreviation),
+        instrument_name=escape(instrument_name),
+        # Channel 10 is for unpitched percussion
+        channel=number if number < 10 else number + 1,
+        program='\n        <midi-program>{}</midi-program>'.format(program) if program else '',
+    )
+
+
+def to_musicxml(music, layout):
+    numbers = range(1, len(music) + 1)
+    return header.format(
+        millimeters=layout['scalingMillimeters'],
+        tenths=layout['scalingTenths'],
+        score_parts='\n'.join(write_score_part(n, musician) for n, musician in zip(numbers, music)),
+        parts='\n'.join(write_part(n, musician) for n, musician in zip(numbers, music)),
+    )
+
+
+def write(music, file_path, layout):
+    with open(file_path, 'w') as f:
+        f.write(to_musicxml(music, layout))
+
+
+# Checking against music21
+
+def read(file_path):
+    """Give what a cell's MusicXML means, to compare how it was written.
+
+    Gives the scaling, and for each part its names, MIDI program, and the
+    sounding MIDI notes and duration of each chord.
+
+    """
+    root = ElementTree.parse(file_path).getroot()
+
+    def text(element, path):
+        found = element.find(path)
+        return found.text if found is not None else None
+
+    scaling = (float(text(root, 'defaults/scaling/millimeters')), float(text(root, 'defaults/scaling/tenths')))
+
+    parts = []
+    for score_part, part in zip(root.findall('part-list/score-part'), root.findall('part')):
+        transpose = 0
+        chromatic = text(part, 'measure/attributes/transpose/chromatic')
+        if chromatic is not None:
+            transpose = int(chromatic) + 12 * int(text(part, 'measure/attributes/transpose/octave-change') or 0)
+        part_divisions = int(text(part, 'measure/attributes/divisions'))
+
+        chords = []
+        for note in part.iter('note'):
+            midi = (steps[text(note, 'pitch/step')] + int(float(text(note, 'pitch/alter') or 0)) +
+                    12 * (int(text(note, 'pitch/octave')) + 1) + transpose)
+            duration = float(text(note, 'duration')) / part_divisions
+            if note.find('chord') is not None:
+                chords[-1][0].append(midi)
+            else:
+                chords.append(([midi], duration))
+
+        parts.append((
+            text(score_part, 'part-name'),
+            text(score_part, 'part-abbreviation'),
+            text(score_part, 'score-instrument/instrument-name'),
+            text(score_part, 'midi-instrument/midi-program'),
+            [(tuple(sorted(midis)), duration) for midis, duration in chords],
+        ))
+
+    return scaling, parts
+
+
+def get_test_cells():
+    """A cell for every instrument, alone and all together, and some chords."""
+    cells = []
+    for instrument in sorted(instruments):
+        for pitches in [[0], [1, 3, 6, 8, 10], [2, 4, 5, 7, 9, 11]]:
+            cells.append([{'instrument': instrument, 'music': [{'pitches': pitches, 'duration': 4.0}]}])
+    cells.append([{'instrument': instrument, 'music': [{'pitches': [pc, (pc + 5) % 12], 'duration': 4.0}]}
+                  for pc, instrument in enumerate(sorted(instruments))])
+    return cells
+
+
+def validate(cells=None):
+    """Write cells both ways and give the ones that differ."""
+    from write_notation_cell import write_musicxml_with_music21, layout_settings
+
+    directory = tempfile.mkdtemp()
+    different = []
+    for i, music in enumerate(cells or get_test_cells()):
+        ours = os.path.join(directory, '{}.xml'.format(i))
+        theirs = os.path.join(directory, '{}-music21.xml'.format(i))
+        write(music, ours, layout_settings)
+        write_musicxml_with_music21(music, theirs)
+        if read(ours) != read(theirs):
+            different.append((music, read(ours), read(theirs)))
+    return different
+
+
+def validate_saved(output_path='output'):
+    """Compare with the cells music21 already wrote for the pieces in output/.
+
+    Gives the number of cells compared and the ones that differ.
+
+    """
+    from grid import Grid
+    from backup import get_piece_paths, get_backup_path
+    from write_notation_cell import layout_settings
+
+    file_path = os.path.join(tempfile.mkdtemp(), 'cell.xml')
+    n = 0
+    different = []
+    for path in get_piece_paths(output_path):
+        if not get_backup_path(path):
+            continue
+        grid = Grid()
+        grid.load(path)
+        for event_index, music in grid.get_cells():
+            saved = os.path.join(path, str(event_index).zfill(2)) + '.xml'
+            if not os.path.exists(saved):
+                continue
+            n += 1
+            write(music, file_path, layout_settings)
+            if read(file_path) != read(saved):
+                different.append((music, read(file_path), read(saved)))
+    return n, different
+
+
+def benchmark(n=200):
+    from write_notation_cell import write_musicxml_with_music21, layout_settings
+
+    cells = get_test_cells()
+    file_path = os.path.join(tempfile.mkdtemp(), 'cell.xml')
+
+    writers = [('musicxml', lambda music: write(music, file_path, layout_settings)),
+               ('music21', lambda music: write_musicxml_with_music21(music, file_path))]
+    results = []
+    for name, write_cell in writers:
+        start = time.time()
+        try:
+            for i in range(n):
+                write_cell(cells[i % len(cells)])
+        except ImportError:
+            print '{:<10} not installed'.format(name)
+            continue
+        results.append((name, (time.time() - start) / n))
+        print '{:<10} {:>10.3f} ms per cell'.format(name, results[-1][1] * 1000)
+
+    if len(results) == 2:
+        print 'musicxml is {:.0f} times faster'.format(results[1][1] / results[0][1])
+
+
+def cli():
+    parser = ArgumentParser(description='Compare the MusicXML writer with music21')
+    parser.add_argument('command', choices=['validate', 'benchmark'])
+    parser.add_argument('--saved', '-s', action='store_true',
+        help='Validate against the cells already in the output directory instead of running music21.')
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with the house_* pieces.')
+    parser.add_argument('--cells', '-n', default=200, type=int,
+        help='The number of cells to write each way in the benchmark.')
+    args = parser.parse_args()
+
+    if args.command == 'validate':
+        if args.saved:
+            n, different = validate_saved(args.output)
+        else:
+            cells = get_test_cells()
+            n, different = len(cells), validate(cells)
+        for music, ours, theirs in different:
+            print music
+            print '  musicxml: {}'.format(ours)
+            print '  music21:  {}'.format(theirs)
+        print '{} of {} cells differ'.format(len(different), n)
+    else:
+        benchmark(args.cells)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,102 @@
+"""Stages that get the events of a piece while it's being made.
+
+`run` makes a piece with `Piece.events` and passes each event to every
+stage as soon as it can't be undone, so output starts long before a long
+piece is finished:
+
+    stages = [EventWriter('events.jsonl'), ScoreReporter()]
+    piece = runner.make_piece(n_events=1000, stages=stages)
+
+A stage has `start`, `add` and `finish`, called with the piece. A
+candidate piece can fail or be rejected along the way, or after `finish`,
+and then the next candidate starts the stages again.
+
+"""
+
+import os
+import sys
+import json
+
+from reports import format_event
+from write_notation_cell import write_musicxml, render_pngs
+
+
+class Stage(object):
+    def start(self, piece):
+        pass
+
+    def add(self, piece, streamed_event):
+        pass
+
+    def finish(self, piece):
+        pass
+
+
+class EventWriter(Stage):
+    """Write each event, its state and harmony as a line of JSON."""
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def start(self, piece):
+        if self.f:
+            self.f.close()
+        self.f = open(self.path, 'w')
+
+    def add(self, piece, streamed_event):
+        self.f.write(json.dumps(streamed_event._asdict()) + '\n')
+        self.f.flush()
+
+    def finish(self, piece):
+        self.f.close()
+        self.f = None
+
+
+class ScoreReporter(Stage):
+    """Print each event like `Grid.report_score`."""
+    def __init__(self, f=sys.stdout):
+        self.f = f
+
+    def add(self, piece, streamed_event):
+        lines = format_event(streamed_event.index, streamed_event.event, piece.musicians_score_order)
+        self.f.write('\n'.join(lines) + '\n')
+        self.f.flush()
+
+
+class CellRenderer(Stage):
+    """Write the MusicXML of each cell as it comes, and render them all at the end."""
+    def __init__(self, path, musescore_path=None, workers=None, timeout=120, dpi=600):
+        self.path = path
+        self.musescore_path = musescore_path
+        self.workers = workers
+        self.timeout = timeout
+        self.dpi = dpi
+
+    def start(self, piece):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.musicxml_file_paths = []
+
+    def add(self, piece, streamed_event):
+        music = piece.get_cell(streamed_event.event)
+        if music:
+            self.musicxml_file_paths.append(write_musicxml(music, self.path, streamed_event.index + 1))
+
+    def finish(self, piece):
+        self.errors = render_pngs(self.musicxml_file_paths, dpi=self.dpi, musescore_path=self.musescore_path,
+                                  timeout=self.timeout, workers=self.workers)
+        for file_path, error in sorted(self.errors.items()):
+            print error
+
+
+def run(piece, stages):
+    """Make `piece`, passing its events through `stages`."""
+    for stage in stages:
+        stage.start(piece)
+
+    for streamed_event in piece.events():
+        for stage in stages:
+            stage.add(piece, streamed_event)
+
+    for stage in stages:
+        stage.finish(piece)
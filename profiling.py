@@ -0,0 +1,76 @@
+"""Time spent and calls made in each stage of making a piece.
+
+Methods marked with `timed` are counted in `profile` while it's enabled,
+which `run.py --profile` does. Stages can be inside others: everything
+is inside "make_piece".
+
+"""
+
+import json
+import functools
+from collections import Counter
+
+from clock import monotonic
+
+
+class Profile(object):
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def get_stats(self):
+        return {'seconds': dict(self.seconds), 'calls': dict(self.calls)}
+
+    def update(self, stats):
+        """Add the stats of another profile, like one from a worker process."""
+        self.seconds.update(stats['seconds'])
+        self.calls.update(stats['calls'])
+
+    def report(self):
+        total = self.seconds['make_piece'] or sum(self.seconds.values())
+        report = ['Profile']
+        report.append('{:<22} {:>8} {:>10} {:>12} {:>7}'.format('stage', 'calls', 'total (s)', 'mean (us)', '%'))
+        for stage, seconds in self.seconds.most_common():
+            calls = self.calls[stage]
+            report.append('{:<22} {:>8} {:>10.3f} {:>12.1f} {:>7.1f}'.format(
+                stage, calls, seconds, seconds / calls * 1e6, seconds * 100 / total if total else 0))
+        return '\n'.join(report)
+
+    def write(self, path):
+        """Write the report, or the stats as JSON if `path` ends with .json."""
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.get_stats(), f, indent=2, sort_keys=True)
+            else:
+                f.write(self.report() + '\n')
+
+
+profile = Profile()
+
+
+def timed(stage):
+    """Count the time and calls of a function as `stage` while profiling.
+
+    The function keeps its name, which `Runner.try_f` counts failures by.
+
+    """
+    def decorate(f):
+        @functools.wraps(f)
+        def timed_f(*args, **kwargs):
+            if not profile.enabled:
+                return f(*args, **kwargs)
+            start = monotonic()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profile.add(stage, monotonic() - start)
+        return timed_f
+    return decorate
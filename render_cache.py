@@ -0,0 +1,91 @@
+"""A cache of rendered notation cells, shared by all pieces.
+
+A cell is kept under the hash of its music (the instruments, pitches and
+durations), the layout and the dpi it was rendered with, as a directory of
+its MusicXML and PNG pages. Using a cell touches its directory, and when
+the cache is bigger than its limit the least recently used cells are
+deleted.
+
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+from manifest import get_files, link
+
+
+default_path = os.path.join('output', 'render_cache')
+default_max_bytes = 200 * 1000 * 1000
+
+
+class RenderCache(object):
+    def __init__(self, path=default_path, max_bytes=default_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get_key(self, music, layout, dpi):
+        thing = {'music': music, 'layout': layout, 'dpi': dpi}
+        return hashlib.sha1(json.dumps(thing, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+    def _get_entry_base(self, key):
+        return os.path.join(self.path, key, 'cell')
+
+    def get(self, key, base):
+        """Link the cached files of a cell to `base`. False if it isn't cached."""
+        entry_base = self._get_entry_base(key)
+        files = get_files(entry_base)
+        if not any(f.endswith('.png') for f in files):
+            self.misses += 1
+            return False
+
+        for source in files:
+            link(source, base + source[len(entry_base):])
+        os.utime(os.path.dirname(entry_base), None)
+        self.hits += 1
+        return True
+
+    def put(self, key, base):
+        """Keep the files of a cell rendered to `base`."""
+        files = get_files(base)
+        entry = os.path.join(self.path, key)
+        if os.path.exists(entry) or not any(f.endswith('.png') for f in files):
+            return
+
+        # Fill a new directory first, so a half kept cell is never found
+        temporary = entry + '.{}'.format(os.getpid())
+        os.mkdir(temporary)
+        for source in files:
+            link(source, os.path.join(temporary, 'cell') + source[len(base):])
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # Kept by someone else in the meantime
+            shutil.rmtree(temporary)
+
+    def evict(self):
+        """Delete the least recently used cells until the cache fits its limit."""
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        entries.sort()
+        evicted = 0
+        while total > self.max_bytes and entries:
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def report(self):
+        return 'Render cache: {} hits, {} misses'.format(self.hits, self.misses)
@@ -0,0 +1,150 @@
+"""The reports of a piece, made in one pass and written to any file.
+
+`Reports` reads the score and the masks of a `Grid` once, event by event,
+and keeps what every report shows. `Grid.get_reports` caches it until the
+next event is added or undone, so asking for more reports costs nothing
+more. Reports are written a block of lines at a time:
+
+    piece.get_reports().write_all(f)
+
+"""
+
+from collections import Counter
+
+from harmony_utils import from_mask, get_chord_types
+
+
+note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# The most lines to join before writing them
+block_size = 1000
+
+
+def spell(chord):
+    return ' '.join([note_names[p] for p in chord])
+
+
+def format_event(index, event, musicians_score_order):
+    """The lines of `report_score` for one event."""
+    lines = [str(index + 1)]
+    for name in [n for n in musicians_score_order if n in event]:
+        action = event[name]
+        if action != 'stop':
+            action = spell(action)
+        lines.append('  {:>12} {}'.format(name, action))
+    lines.append('')
+    return lines
+
+
+def write_lines(f, lines):
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) == block_size:
+            f.write('\n'.join(block) + '\n')
+            block = []
+    if block:
+        f.write('\n'.join(block) + '\n')
+
+
+class Reports(object):
+    def __init__(self, grid):
+        self.musicians_score_order = grid.musicians_score_order
+        self.score = grid.score
+        width = len(self.musicians_score_order)
+
+        # Where each musician plays, and the pitches of each musician in
+        # each state
+        rhythm = [[] for _ in range(width)]
+        self.reality = []
+        self.harmony_lines = []
+        self.harmony_counter = Counter()
+        self.density = Counter()
+        harmony_lines = {}
+        harmonies_in_order = []
+
+        for index in range(len(self.score)):
+            row = grid._pitch_masks[index * width:(index + 1) * width]
+            harmony_mask = grid._harmony_masks[index]
+
+            self.reality.append([from_mask(mask) for mask in row])
+            n_playing = 0
+            for i, mask in enumerate(row):
+                if mask:
+                    rhythm[i].append('-')
+                    n_playing += 1
+                else:
+                    rhythm[i].append(' ')
+            self.density[n_playing] += 1
+
+            harmony = from_mask(harmony_mask)
+            if harmony_mask not in harmony_lines:
+                harmonies_in_order.append(harmony)
+                harmony_lines[harmony_mask] = ''.join(
+                    ['{:<3}'.format(pc) if harmony_mask & (1 << pc) else '   ' for pc in range(12)])
+            self.harmony_counter[harmony] += 1
+            self.harmony_lines.append(harmony_lines[harmony_mask])
+
+        self.rhythm = [''.join(line) for line in rhythm]
+
+        # Counted once for each different harmony, in the order they came
+        self.chord_type_counter = Counter()
+        for harmony in harmonies_in_order:
+            for chord_type in get_chord_types(harmony):
+                self.chord_type_counter[chord_type] += self.harmony_counter[harmony]
+
+    def get_score_lines(self):
+        for index, event in enumerate(self.score):
+            for line in format_event(index, event, self.musicians_score_order):
+                yield line
+
+    def get_rhythm_lines(self):
+        max_name_length = max([len(n) for n in self.musicians_score_order])
+        label_template = '{{:<{}}}  '.format(max_name_length)
+        for name, line in zip(self.musicians_score_order, self.rhythm):
+            yield label_template.format(name) + line
+
+    def get_harmony_lines(self):
+        for line in self.harmony_lines:
+            yield line
+        yield ''
+        yield 'Number of different chords:  {}'.format(len(self.harmony_counter))
+        for harmony, n in self.harmony_counter.most_common():
+            yield '{} {}'.format(n, harmony)
+
+        yield ''
+        yield 'Number of different chord types:  {}'.format(len(self.chord_type_counter))
+        for chord_type, count in self.chord_type_counter.most_common():
+            yield '{:<5} {}'.format(str(count), str(chord_type))
+
+    def get_reality_lines(self):
+        yield ''.join(['{:<12}'.format(name) for name in self.musicians_score_order])
+        for row in self.reality:
+            yield ''.join(['{:<12}'.format(' '.join([str(pc) for pc in pitches])) for pitches in row])
+
+    def get_density_lines(self):
+        yield 'Density'
+        for d, c in self.density.most_common():
+            yield '{} {}'.format(d, c)
+
+    def write_score(self, f):
+        write_lines(f, self.get_score_lines())
+
+    def write_rhythm(self, f):
+        write_lines(f, self.get_rhythm_lines())
+
+    def write_harmonies(self, f):
+        write_lines(f, self.get_harmony_lines())
+
+    def write_reality(self, f):
+        write_lines(f, self.get_reality_lines())
+
+    def write_density(self, f):
+        write_lines(f, self.get_density_lines())
+
+    def write_all(self, f):
+        for write in [self.write_score, self.write_rhythm, self.write_harmonies, self.write_reality]:
+            f.write('\n')
+            write(f)
+        f.write('\n')
+        self.write_density(f)
@@ -2,90 +2,286 @@
 
 from argparse import ArgumentParser
 from collections import Counter
-import datetime
-
+from multiprocessing import Pool
+from Queue import Queue
+import os
+import json
+import random
+import logging
+import traceback
+
+from clock import monotonic
 from feb3 import Piece
+from criteria import Criteria, Rejected, load_rules
+from failures import GenerationFailure, RetriesExhausted
+from grid import get_new_path
+from seeds import Seeds
+import render_cache
+import pipeline
+import logs
+from profiling import profile, timed
+
+
+log = logging.getLogger(__name__)
+
+
+def _attempt(args):
+    """Make one candidate piece in a worker process.
+
+    Gives (good, piece state, counters, error), the counters being the
+    exception and backtrack counters, the timeouts and the profile. Errors that aren't
+    generation failures are passed back as a traceback, because a worker
+    that raises would never report back.
+
+    """
+    seed, n_events, quentin, settings, rules = args
+    profile.reset()
+    runner = Runner(criteria=Criteria(rules), **settings)
+    piece = None
+    error = None
+    try:
+        piece = runner.make_piece(n_events=n_events, quentin=quentin, seed=seed)
+    except (Rejected, RetriesExhausted):
+        # Another worker will probably find a piece.
+        pass
+    except Exception:
+        error = traceback.format_exc()
+
+    good = bool(piece) and runner.is_good(piece)
+
+    # Taken after is_good, so the profile has it too
+    counters = runner.exception_counter, runner.backtrack_counter, runner.timeouts, profile.get_stats()
+    if good:
+        return True, piece.to_dict(), counters, error
+    return False, None, counters, error
 
 
 class Runner(object):
-    def __init__(self, test=False, max_depth=500):
+    def __init__(self, test=False, max_depth=500, budgets=None, timeout=4,
+                 backtrack_depth=3, max_backtracks=5, criteria=None, seed=None):
         self.test = test
+
+        # The most attempts any function gets, and the attempts particular
+        # functions get, by name
         self.max_depth = max_depth
-        self.start_time = datetime.datetime.now()
+        self.budgets = budgets or {}
+
+        # Seconds to make a piece in before giving up on retries
+        self.timeout = timeout
+
+        # How many events to undo at a dead end, and how many times to do it
+        # for one piece
+        self.backtrack_depth = backtrack_depth
+        self.max_backtracks = max_backtracks
+
+        self.criteria = criteria or Criteria()
+        self.exception_counter = Counter()
+        self.backtrack_counter = Counter()
+        self.deadline = monotonic() + self.timeout
+
+        # The number of times a retry ran out of time while making the last
+        # piece. A piece that had any can't be made again from its seed.
+        self.timeouts = 0
+
+        # Gives the seed of each candidate piece
+        self.random = random.Random(seed)
+
+    @property
+    def settings(self):
+        return {
+            'test': self.test,
+            'max_depth': self.max_depth,
+            'budgets': self.budgets,
+            'timeout': self.timeout,
+            'backtrack_depth': self.backtrack_depth,
+            'max_backtracks': self.max_backtracks,
+        }
+
+    def get_config(self, n_events=40, quentin=False):
+        """Everything besides the seed that decides which piece is made (see seeds.py).
+
+        The criteria are in it as they'd be read back from JSON, because a
+        piece is rejected part way through by different rules.
+
+        """
+        config = dict(self.settings, n_events=n_events, quentin=quentin)
+        config['criteria'] = json.loads(json.dumps(self.criteria.rules))
+        del config['timeout']
+        return config
+
+    def get_piece(self, n_events=40, quentin=False, workers=1, stages=None, backup=True):
+        """Make candidate pieces until one is good, and keep it (see `keep`)."""
+        if workers > 1:
+            if stages:
+                raise ValueError('Events can only be streamed from one worker')
+            return self.get_piece_in_parallel(n_events=n_events, quentin=quentin, workers=workers, backup=backup)
 
-    def get_piece(self, n_events=40, quentin=False):
         i = 0
         while True:
-            print i
+            log.info('Candidate %d', i)
             i += 1
-            self.exception_counter = Counter()
-            piece = Piece(self, n_events=n_events, quentin=quentin)
-            self.start_time = datetime.datetime.now()
-            piece.run()
+            try:
+                piece = self.make_piece(n_events=n_events, quentin=quentin, stages=stages)
+            except (Rejected, RetriesExhausted):
+                continue
             if self.is_good(piece):
-                piece.save()
+                self.keep(piece, n_events=n_events, quentin=quentin, backup=backup)
                 return piece
 
-    def is_good(self, piece):
-        # TODO add more assessment of the whole piece here if you want.
+    @timed('make_piece')
+    def make_piece(self, n_events=40, quentin=False, stages=None, seed=None):
+        """Make a candidate piece, passing its events to `stages` if given (see pipeline.py).
+
+        The seed is the next one from `self.random` unless it's given.
+
+        """
+        if seed is None:
+            seed = self.random.randrange(2 ** 32)
+        self.exception_counter = Counter()
+        self.backtrack_counter = Counter()
+        self.timeouts = 0
+        piece = Piece(self, n_events=n_events, quentin=quentin, seed=seed)
+        self.criteria.check_ensemble(piece.musicians)
+        piece.monitors.append(self.criteria.monitor())
+        self.deadline = monotonic() + self.timeout
+        if stages:
+            pipeline.run(piece, stages)
+        else:
+            piece.run()
+        return piece
 
-        # Should have:
-        # - at least one gap
-        if piece.gaps < 1:
-            return False
+    def get_piece_in_parallel(self, n_events=40, quentin=False, workers=2, backup=True):
+        """Make candidate pieces on `workers` processes until one is good.
 
-        # - at least one solo for Kristin
-        if piece.solos['Kristin'] < 1:
-            return False
-        # - at least one solo for Trevor
-        # if piece.solos['Trevor'] < 1:
-        #     return False
+        Each candidate gets its own seed. The exceptions of every candidate
+        are merged into `exception_counter`, and only the first good piece
+        is saved.
 
-        # - at least 3 states where five people are playing
-        if piece.density[5] < 3:
-            return False
+        """
+        self.exception_counter = Counter()
+        self.backtrack_counter = Counter()
+        results = Queue()
+        base_seed = self.random.randrange(2 ** 32)
+        pool = Pool(workers)
 
-        # - at least 2 states where six people are playing
-        if piece.density[6] < 2:
-            return False
+        def submit(i):
+            args = (base_seed + i, n_events, quentin, self.settings, self.criteria.rules)
+            pool.apply_async(_attempt, [args], callback=results.put)
 
-        # # At least 8 quartets
-        # if piece.density[4] < 8:
-        #     return False
-        # # There should be more quartets than trios
-        # if piece.density[4] < piece.density[3]:
-        #     return False
-        # # if piece.density[3] < piece.density[2]:
-        # #     return False
-        # No more than 5 solos
-        if piece.density[1] > 5:
-            return False
+        try:
+            # Keep one candidate queued per worker
+            for i in range(workers):
+                submit(i)
+
+            i = 0
+            while True:
+                log.info('Candidate %d', i)
+                good, state, (exception_counter, backtrack_counter, timeouts, profile_stats), error = results.get()
+                self.exception_counter.update(exception_counter)
+                self.backtrack_counter.update(backtrack_counter)
+                profile.update(profile_stats)
+                if error:
+                    raise RuntimeError('A worker failed:\n' + error)
+                if good:
+                    self.timeouts = timeouts
+                    break
+                submit(i + workers)
+                i += 1
+        finally:
+            pool.terminate()
+            pool.join()
+
+        piece = Piece(self, n_events=n_events, quentin=quentin, seed=state['seed'])
+        piece.from_dict(state)
+        self.keep(piece, n_events=n_events, quentin=quentin, backup=backup)
+        return piece
+
+    def keep(self, piece, n_events=40, quentin=False, backup=True):
+        """Save `piece` with a backup, and its seed in output/seeds.json.
+
+        Without `backup` only the seed is saved, unless the piece can't be
+        made again from it.
+
+        """
+        if backup or self.timeouts:
+            piece.save()
+        else:
+            piece.path = get_new_path()
+            print 'SAVING SEED {} AS {}'.format(piece.seed, piece.path)
+
+        if not self.timeouts:
+            seeds = Seeds(os.path.dirname(piece.path))
+            seeds.add(piece.path, piece.seed, self.get_config(n_events, quentin), piece.score)
+            seeds.save()
+
+    @timed('is_good')
+    def is_good(self, piece):
+        return self.criteria.is_good(piece)
 
-        return True
+    def try_f(self, f, args=[], kwargs={}):
+        """Try a random process until it works or runs out of attempts or time.
 
-    def try_f(self, f, args=[], kwargs={}, depth=0):
-        """Dumb way to try a random process a bunch of times."""
+        Failures are counted in `exception_counter` by function name and
+        failure type. When a function runs out, `RetriesExhausted` is raised,
+        which the function that called `try_f` can fail with in turn.
+
+        """
         if self.test:
             return f(*args, **kwargs)
-        depth += 1
-        try:
-            return f(*args, **kwargs)
-        except Exception as e:
-            self.exception_counter['{}: {}'.format(f.__name__, e.message)] += 1
-            timed_out = datetime.datetime.now() - self.start_time > datetime.timedelta(0, 4)
-            if depth == self.max_depth or timed_out:
-                msg = "Tried {} {} times. Exception: {}"
-                msg = msg.format(f.__name__, self.max_depth, e)
+
+        name = f.__name__
+        max_attempts = self.budgets.get(name, self.max_depth)
+        attempts = 0
+        while True:
+            try:
+                return f(*args, **kwargs)
+            except GenerationFailure as failure:
+                attempts += 1
+                self.exception_counter[(name, type(failure).__name__)] += 1
+                timed_out = monotonic() > self.deadline
                 if timed_out:
-                    msg += ' Timed out.'
-                print msg
-                raise e
-            return self.try_f(f, args=args, kwargs=kwargs, depth=depth)
+                    self.timeouts += 1
+                if attempts >= max_attempts or timed_out or not failure.retry:
+                    exhausted = RetriesExhausted(name, attempts, timed_out, failure)
+                    log.info('%s', exhausted)
+                    raise exhausted
+
+    def backtrack(self, piece):
+        """Undo the last few events of `piece` after a dead end.
+
+        Gives whether the piece should keep going.
+
+        """
+        if self.backtrack_counter['backtracks'] >= self.max_backtracks or not piece.score:
+            self.backtrack_counter['gave up'] += 1
+            return False
+
+        n_events = min(self.backtrack_depth, len(piece.score))
+        piece.rollback(len(piece.score) - n_events)
+        self.backtrack_counter['backtracks'] += 1
+        self.backtrack_counter['events undone'] += n_events
+
+        # Give the piece a fresh amount of time from here
+        self.deadline = monotonic() + self.timeout
+        return True
+
+    def undoable(self, piece):
+        """The most events of `piece` that backtracking could still undo."""
+        backtracks_left = max(self.max_backtracks - self.backtrack_counter['backtracks'], 0)
+        return min(backtracks_left * self.backtrack_depth, len(piece.score))
 
     def report_exceptions(self):
         report = ['Exceptions Report']
-        for exception, count in self.exception_counter.most_common():
-            line = '{:<6}{}'.format(count, exception)
+        for (function, failure), count in self.exception_counter.most_common():
+            line = '{:<6}{}: {}'.format(count, function, failure)
+            report.append(line)
+
+        return '\n'.join(report)
+
+    def report_backtracks(self):
+        report = ['Backtracks Report']
+        for name in ['backtracks', 'events undone', 'gave up']:
+            line = '{:<6}{}'.format(self.backtrack_counter[name], name)
             report.append(line)
 
         return '\n'.join(report)
@@ -99,6 +295,28 @@ def cli():
     parser.add_argument('--max-depth', '-m', default=500,
         help='The maximum number of exceptions before quitting retries.',
         type=int)
+    parser.add_argument('--budget', '-b', action='append', default=[],
+        metavar='FUNCTION=N',
+        help='The maximum number of exceptions before quitting retries of one function, '
+             'like pick_harmony=100. Can be given more than once.')
+    parser.add_argument('--backtrack-depth', default=3, type=int,
+        help='The number of events to undo when a piece reaches a dead end.')
+    parser.add_argument('--max-backtracks', default=5, type=int,
+        help='The number of times to backtrack before giving up on a piece.')
+    parser.add_argument('--workers', '-w', default=1,
+        help='The number of processes to make candidate pieces with.',
+        type=int)
+    parser.add_argument('--criteria', '-c',
+        help='A JSON file of rules a piece must follow to be kept. See criteria.py')
+    parser.add_argument('--seed', type=int,
+        help='Seed the candidate pieces with this, to make the same pieces again.')
+
+    parser.add_argument('--profile', nargs='?', const='-', metavar='PATH',
+        help='Time each stage of making pieces and print the breakdown at the end, '
+             'or write it to PATH (as JSON if PATH ends with .json).')
+    parser.add_argument('--log-level', default='warning', choices=logs.levels,
+        help='Log messages at this level and above. info shows each candidate and each function '
+             'that ran out of retries.')
 
     # Options for what the music will be like
     parser.add_argument('--events', '-e', default=40,
@@ -108,11 +326,29 @@ def cli():
         help='Use Quentin band instrumentation rather than the default Sonic Lib ensemble')
 
     # Output options
+    parser.add_argument('--seed-only', action='store_true',
+        help='Keep the piece only as its seed in output/seeds.json, without a backup. See seeds.py')
+    parser.add_argument('--stream', metavar='PATH',
+        help='Write each event to PATH as a line of JSON as soon as it is made. '
+             'Starts over with each candidate piece.')
+
     parser.add_argument('--notate_harmonies', '-n', action='store_true',
         help='Open harmonies in Sibelius')
 
     parser.add_argument('--pngs', '-p', action='store_true',
         help='Make PNG images of notation of each cell')
+    parser.add_argument('--musescore',
+        help='The MuseScore executable to render PNGs with. Defaults to $MUSESCORE, then the macOS app.')
+    parser.add_argument('--render-workers', type=int,
+        help='The number of MuseScore processes to render with at once. Defaults to the number of CPUs.')
+    parser.add_argument('--render-timeout', default=120, type=int,
+        help='The number of seconds to let MuseScore render one cell.')
+    parser.add_argument('--render-cache', default=render_cache.default_path,
+        help='The directory of rendered cells to reuse.')
+    parser.add_argument('--render-cache-size', default=render_cache.default_max_bytes / 1000000, type=int,
+        help='The most megabytes the render cache can hold before old cells are deleted.')
+    parser.add_argument('--no-render-cache', action='store_true',
+        help='Render every cell that is new to this output directory.')
 
     parser.add_argument('--score', '-s', action='store_true',
         help='Print the score to the screen')
@@ -134,12 +370,40 @@ def cli():
 
     args = parser.parse_args()
 
-    runner = Runner(test=args.test, max_depth=args.max_depth)
+    logs.configure(args.log_level)
+    profile.enabled = bool(args.profile)
+
+    criteria = None
+    if args.criteria:
+        criteria = Criteria(load_rules(args.criteria))
+
+    budgets = {}
+    for budget in args.budget:
+        name, n = budget.split('=')
+        budgets[name] = int(n)
+
+    runner = Runner(test=args.test, max_depth=args.max_depth, budgets=budgets,
+                    backtrack_depth=args.backtrack_depth, max_backtracks=args.max_backtracks,
+                    criteria=criteria, seed=args.seed)
 
-    p = runner.get_piece(n_events=args.events, quentin=args.quentin)
+    if args.seed_only and (args.pngs or args.notate_harmonies):
+        parser.error('--seed-only saves no directory to put notation in')
+
+    stages = []
+    if args.stream:
+        if args.workers > 1:
+            parser.error('--stream only works with one worker')
+        stages.append(pipeline.EventWriter(args.stream))
+
+    p = runner.get_piece(n_events=args.events, quentin=args.quentin, workers=args.workers, stages=stages,
+                         backup=not args.seed_only)
 
     if args.pngs:
-        p.pngs()
+        cache = None
+        if not args.no_render_cache:
+            cache = render_cache.RenderCache(args.render_cache, args.render_cache_size * 1000000)
+        p.pngs(musescore_path=args.musescore, workers=args.render_workers, timeout=args.render_timeout,
+               cache=cache)
 
     if args.notate_harmonies:
         p.notate_harmonies()
@@ -149,7 +413,7 @@ def cli():
         print
 
     if args.rhythm:
-        print p.report_rhythm()
+        p.report_rhythm()
         print
 
     if args.harmonies:
@@ -160,6 +424,8 @@ def cli():
         print
         print runner.report_exceptions()
         print
+        print runner.report_backtracks()
+        print
 
     if args.reality:
         p.report_reality()
@@ -170,6 +436,13 @@ def cli():
         print
         print runner.report_exceptions()
         print
+        print runner.report_backtracks()
+        print
+
+    if args.profile == '-':
+        print profile.report()
+    elif args.profile:
+        profile.write(args.profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Pieces kept as the seeds that made them, and made again exactly.
+
+Every choice made for a piece comes from its own `random.Random`, so the
+same seed, ensemble, criteria and runner settings make the same piece
+again. Those are the config (see `Runner.get_config`), saved once in
+output/seeds.json under their hash, and each kept piece is saved there
+as its seed, the hash of its config and the hash of its score:
+
+    ./run.py --seed-only        keep the piece as a seed, without a backup
+    ./seeds.py list
+    ./seeds.py replay PATH      make the piece again and save its backup
+    ./seeds.py check            make every piece again and compare scores
+    ./seeds.py prune            delete the backups of pieces that check out
+
+A piece where a retry ran out of time can't be made again from its seed,
+so it's always saved with a backup and never as a seed. Changing the code
+that makes pieces can change the piece a seed makes, which `check` finds.
+So can the order of dicts keyed by musician, so pieces are only made
+again exactly without hash randomization (Python 2's default).
+
+"""
+
+import os
+import json
+import hashlib
+from argparse import ArgumentParser
+
+import backup
+from manifest import score_hash
+from criteria import Criteria, Rejected, parse_rules
+from failures import RetriesExhausted
+
+
+file_name = 'seeds.json'
+
+
+class ReplayError(Exception):
+    pass
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+class Seeds(object):
+    def __init__(self, output_path='output'):
+        self.path = os.path.join(output_path, file_name)
+        self.configs = {}
+        self.pieces = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                d = json.load(f)
+            self.configs = d['configs']
+            self.pieces = d['pieces']
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'configs': self.configs, 'pieces': self.pieces}, f, indent=1, sort_keys=True)
+
+    def add(self, path, seed, config, score):
+        h = config_hash(config)
+        self.configs[h] = config
+        self.pieces[path] = {'seed': seed, 'config': h, 'score': score_hash(score)}
+
+    def replay(self, path):
+        """Make the piece at `path` again, checking it has the same score."""
+        record = self.pieces[path]
+        try:
+            piece = replay(record['seed'], self.configs[record['config']])
+        except (Rejected, RetriesExhausted) as e:
+            raise ReplayError('Seed {} failed to make {}: {}'.format(record['seed'], path, e))
+        if score_hash(piece.score) != record['score']:
+            raise ReplayError('Seed {} made a different piece than {}'.format(record['seed'], path))
+        return piece
+
+
+def replay(seed, config):
+    """Make the piece `seed` makes with `config`, with no time limit."""
+    from run import Runner
+
+    settings = dict(config)
+    n_events = settings.pop('n_events')
+    quentin = settings.pop('quentin')
+    # Configs saved before the criteria were in them were made with the defaults
+    rules = settings.pop('criteria', None)
+    criteria = Criteria(None if rules is None else parse_rules(rules))
+    runner = Runner(timeout=float('inf'), criteria=criteria, **settings)
+    return runner.make_piece(n_events=n_events, quentin=quentin, seed=seed)
+
+
+def cli():
+    parser = ArgumentParser(description='Make pieces kept as seeds again')
+    parser.add_argument('command', choices=['list', 'replay', 'check', 'prune'])
+    parser.add_argument('paths', nargs='*',
+        help='The pieces to replay, like output/house_20160319_120000_000000. Defaults to every piece.')
+    parser.add_argument('--output', '-o', default='output',
+        help='The directory with seeds.json.')
+    args = parser.parse_args()
+
+    seeds = Seeds(args.output)
+    paths = args.paths or sorted(seeds.pieces)
+
+    if args.command == 'list':
+        for path in paths:
+            record = seeds.pieces[path]
+            has_backup = 'backup' if backup.get_backup_path(path) else 'seed only'
+            print '{}  {:>10}  {}  {}'.format(path, record['seed'], record['config'][:8], has_backup)
+        return
+
+    failed = 0
+    pruned = 0
+    for path in paths:
+        try:
+            piece = seeds.replay(path)
+        except ReplayError as e:
+            print e
+            failed += 1
+            continue
+
+        if args.command == 'replay':
+            piece.save(path)
+        elif args.command == 'prune':
+            backup_path = backup.get_backup_path(path)
+            if backup_path:
+                os.remove(backup_path)
+                pruned += 1
+
+    print '{} of {} pieces made again exactly'.format(len(paths) - failed, len(paths))
+    if args.command == 'prune':
+        print 'Deleted {} backups'.format(pruned)
+
+
+if __name__ == '__main__':
+    cli()
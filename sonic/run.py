@@ -21,13 +21,13 @@ from ensemble import Ensemble
 # from graph import Graph
 
 
-def make_phrase():
+def make_phrase(rng=random):
     phrase = []
     total_duration = 0  # in microbeats
     length = 4
     while total_duration < length:
-        pitch = random.choice(['rest', 60, 61, 62, 63, 64, 65, 66, 67, 68, 62, 63, 64, 65, 66])
-        duration = random.choice([.25, .5, .75, 1.0, 1.25, 1.5])
+        pitch = rng.choice(['rest', 60, 61, 62, 63, 64, 65, 66, 67, 68, 62, 63, 64, 65, 66])
+        duration = rng.choice([.25, .5, .75, 1.0, 1.25, 1.5])
         if total_duration + duration > length:
             duration = length - total_duration
 
@@ -59,7 +59,7 @@ def main():
     song = Song()
 
     phrase1_offset = 0
-    phrase1 = make_phrase()
+    phrase1 = make_phrase(song.random)
 
     for n in phrase1:
         song.ensemble.oboe['music'].append({
@@ -112,9 +112,13 @@ class Song(object):
     title = 'Working Title'
     composer = 'Jonathan Marmor'
 
-    def __init__(self):
+    def __init__(self, seed=None):
         self.ensemble = Ensemble(instruments)
 
+        # Every choice made for the song comes from `self.random`
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.random = random.Random(self.seed)
+
         # self.graph = Graph(self.ensemble)
 
         # self.make_music()
@@ -8,11 +8,11 @@ class S(object):
             args = kwargs['arguments']
         self.weighted_options = args
 
-    def choose(self):
+    def choose(self, rng=random):
         weights, options = zip(*self.weighted_options)
-        choice = weighted_choice(options, weights)
+        choice = weighted_choice(options, weights, rng)
         if isinstance(choice, S):
-            return choice.choose()
+            return choice.choose(rng)
         return choice
 
 
@@ -31,8 +31,8 @@ def scale(x, minimum, maximum, floor=0, ceiling=1):
     return ((ceiling - floor) * (float(x) - minimum)) / (maximum - minimum) + floor
 
 
-def weighted_choice(options, weights):
-    rand = random.random()
+def weighted_choice(options, weights, rng=random):
+    rand = rng.random()
     rand = scale(rand, 0, 1, 0, sum(weights))
     total = 0
     for i, weight in enumerate(weights):
@@ -1,15 +1,15 @@
 import random
 
 
-def weighted_choice_lists(options, weights):
-    """Choose an item from options using weights
+def weighted_choice_lists(options, weights, rng=random):
+    """Choose an item from options using weights, drawing from `rng`
 
     >>> weighted_choice_lists([1, 2], [100000, 0.000001])
     1
 
     """
     sum_of_weights = sum(weights)
-    rand = random.uniform(0, sum_of_weights)
+    rand = rng.uniform(0, sum_of_weights)
     total = 0
     for item, weight in zip(options, weights):
         total += weight
@@ -17,7 +17,7 @@ def weighted_choice_lists(options, weights):
             return item
 
 
-def weighted_choice(pairs):
+def weighted_choice(pairs, rng=random):
     """Choose an item from a list of (item, weight) pairs
 
     >>> pairs = [(1, 10000), (2, 0.000001)]
@@ -26,10 +26,10 @@ def weighted_choice(pairs):
 
     """
     options, weights = zip(*pairs)
-    return weighted_choice_lists(options, weights)
+    return weighted_choice_lists(options, weights, rng)
 
 
-def weighted_choice_dict(d):
+def weighted_choice_dict(d, rng=random):
     """Choose a key from a dict using the values as weights.
 
     Works for collections.Counter using the counts as weights.
@@ -39,4 +39,5 @@ def weighted_choice_dict(d):
     (0, 4, 7)
 
     """
-    return weighted_choice(d.items())
+    return weighted_choice(d.items(), rng)
+
@@ -1,30 +1,148 @@
 import os
+import time
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
-from music21.note import Note, Rest
-from music21.pitch import Pitch
-from music21.chord import Chord
-from music21.stream import Part, Score
-from music21.duration import Duration
-from music21.layout import StaffGroup, ScoreLayout
-from music21.instrument import fromString as get_instrument
-from music21.clef import BassClef
-from music21.metadata import Metadata
+import musicxml
+from clock import monotonic
 
 
-def write_png_with_musescore(musicxml_file_path, output_file_path, dpi=None):
-    musescore_path = '/Applications/MuseScore 2.app/Contents/MacOS/mscore'
+# Set MUSESCORE to the MuseScore executable, or to a stand-in that takes the
+# same arguments
+default_musescore_path = '/Applications/MuseScore 2.app/Contents/MacOS/mscore'
 
+layout_settings = {
+    'scalingMillimeters': 1.25,
+    'scalingTenths': 40,
+}
+
+# What a cell in a `RenderCache` was rendered with, besides its music and dpi
+cache_settings = dict(layout_settings, writer=musicxml.writer)
+
+
+class RenderError(Exception):
+    pass
+
+
+def get_musescore_path(musescore_path=None):
+    return musescore_path or os.environ.get('MUSESCORE') or default_musescore_path
+
+
+def write_png_with_musescore(musicxml_file_path, output_file_path, dpi=None, musescore_path=None, timeout=120):
+    """Render a MusicXML file to PNG. MuseScore adds the page number to the name."""
     if not output_file_path.endswith('.png'):
         output_file_path += '.png'
 
-    command = '"{}" {} -o {} -T 0'.format(musescore_path, musicxml_file_path, output_file_path)
+    command = [get_musescore_path(musescore_path), musicxml_file_path, '-o', output_file_path, '-T', '0']
     if dpi:
-        command += ' -r {}'.format(dpi)
-
-    os.system(command)
-
+        command += ['-r', str(dpi)]
+
+    with open(os.devnull, 'w') as devnull:
+        try:
+            process = subprocess.Popen(command, stdout=devnull, stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise RenderError('Could not run {}: {}'.format(command[0], e))
+
+        # Poll often at first, so a quick render isn't kept waiting, then
+        # back off to 50 ms
+        deadline = monotonic() + timeout
+        wait = 0.001
+        while process.poll() is None:
+            if monotonic() > deadline:
+                process.kill()
+                process.wait()
+                raise RenderError('Rendering {} took more than {} seconds'.format(musicxml_file_path, timeout))
+            time.sleep(wait)
+            wait = min(wait * 2, 0.05)
+
+    if process.returncode:
+        raise RenderError('Rendering {} failed with exit code {}'.format(musicxml_file_path, process.returncode))
+
+
+def _render(args):
+    musicxml_file_path, dpi, musescore_path, timeout = args
+    try:
+        write_png_with_musescore(musicxml_file_path, musicxml_file_path[:-len('.xml')] + '.png',
+                                 dpi=dpi, musescore_path=musescore_path, timeout=timeout)
+    except RenderError as e:
+        return musicxml_file_path, str(e)
+    return musicxml_file_path, None
+
+
+def render_pngs(musicxml_file_paths, dpi=600, musescore_path=None, timeout=120, workers=None):
+    """Render MusicXML files to PNG, with `workers` renderers at a time.
+
+    Gives the errors of the files that couldn't be rendered, by file.
+    A stand-in for MuseScore takes the same arguments, like one that
+    hangs on some files:
+
+    >>> import tempfile
+    >>> stand_in = os.path.join(tempfile.mkdtemp(), 'mscore')
+    >>> with open(stand_in, 'w') as f:
+    ...     f.write('#!/bin/sh\\ncase "$1" in *slow*) sleep 10;; esac\\n')
+    >>> os.chmod(stand_in, 0o755)
+    >>> errors = render_pngs(['fast.xml', 'slow.xml'], musescore_path=stand_in, timeout=0.5)
+    >>> errors
+    {'slow.xml': 'Rendering slow.xml took more than 0.5 seconds'}
+
+    """
+    jobs = [(file_path, dpi, musescore_path, timeout) for file_path in musicxml_file_paths]
+    if not jobs:
+        return {}
+
+    # Each worker only waits on a renderer process, so threads are enough
+    pool = ThreadPool(workers or cpu_count())
+    try:
+        results = pool.map(_render, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return {file_path: error for file_path, error in results if error}
+
+
+def write_notation_cell(music, path, event_index, dpi=600, musescore_path=None, cache=None):
+    """Write and render a cell, or take it from a `RenderCache`."""
+    base = os.path.join(path, str(event_index).zfill(2))
+    if cache:
+        key = cache.get_key(music, cache_settings, dpi)
+        if cache.get(key, base):
+            return
+
+    musicxml_file_path = write_musicxml(music, path, event_index)
+    write_png_with_musescore(musicxml_file_path, base + '.png', dpi=dpi, musescore_path=musescore_path)
+
+    if cache:
+        cache.put(key, base)
+        cache.evict()
+
+
+def write_musicxml(music, path, event_index):
+    """Write the MusicXML of a cell, without rendering it. Gives its path.
+
+    Cells `musicxml` can write are written without music21.
+
+    """
+    musicxml_file_path = os.path.join(path, str(event_index).zfill(2)) + '.xml'
+    if musicxml.can_write(music):
+        musicxml.write(music, musicxml_file_path, layout_settings)
+    else:
+        write_musicxml_with_music21(music, musicxml_file_path)
+    return musicxml_file_path
+
+
+def write_musicxml_with_music21(music, musicxml_file_path):
+    # music21 takes a long time to import, so only import it to write cells
+    from music21.note import Note
+    from music21.pitch import Pitch
+    from music21.chord import Chord
+    from music21.stream import Part, Score
+    from music21.duration import Duration
+    from music21.layout import ScoreLayout
+    from music21.instrument import fromString as get_instrument
+    from music21.metadata import Metadata
 
-def write_notation_cell(music, path, event_index):
     score = Score()
 
     metadata = Metadata()
@@ -33,8 +151,8 @@ def write_notation_cell(music, path, event_index):
     score.insert(0, metadata)
 
     layout = ScoreLayout()
-    layout.scalingMillimeters = 1.25
-    layout.scalingTenths = 40
+    layout.scalingMillimeters = layout_settings['scalingMillimeters']
+    layout.scalingTenths = layout_settings['scalingTenths']
     score.insert(0, layout)
 
     for musician in music:
@@ -70,10 +188,4 @@ def write_notation_cell(music, path, event_index):
 
             part.append(note)
 
-    file_path = os.path.join(path, str(event_index).zfill(2))
-    musicxml_file_path = file_path + '.xml'
-    png_output_file_path = file_path + '.png'
-
     score.write('musicxml', musicxml_file_path)
-
-    write_png_with_musescore(musicxml_file_path, png_output_file_path, dpi=600)